@@ -0,0 +1,232 @@
+import argparse
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from multiprocessing import get_context
+
+import polars as pl
+from infodump_tools.calculate import calculate_stats, get_local_publication_timestamp
+from infodump_tools.config import INFODUMP_FILENAMES, KEY_TIMESTAMP
+from infodump_tools.output import write_json
+from infodump_tools.sources import source_exists
+from polars import DataFrame
+
+BACKFILL_WORKERS = 4
+BACKFILL_PARQUET = "backfill.parquet"
+
+# restic restores a snapshot's files under the path they were backed up from
+SNAPSHOT_INFODUMP_DIR = "infodump"
+
+
+def find_snapshots(snapshots_dir: str) -> dict[str, str]:
+    """
+    Snapshot directories in snapshots_dir, by name, sorted, with the directory holding each one's Infodump files: the snapshot directory itself, or its infodump subdirectory. Directories without every Infodump file are skipped.
+    """
+    snapshots = {}
+    for name in sorted(os.listdir(snapshots_dir)):
+        snapshot_dir = os.path.join(snapshots_dir, name)
+        if not os.path.isdir(snapshot_dir):
+            continue
+
+        for infodump_dir in [
+            snapshot_dir,
+            os.path.join(snapshot_dir, SNAPSHOT_INFODUMP_DIR),
+        ]:
+            if all(
+                source_exists(infodump_dir, filename) for filename in INFODUMP_FILENAMES
+            ):
+                snapshots[name] = infodump_dir
+                break
+        else:
+            print(f'Skip "{name}": not an Infodump snapshot')
+
+    return snapshots
+
+
+def to_time_series(out: dict) -> DataFrame:
+    """
+    Stats' monthly series in long form, one row per site, metric, series and month: every series (or list of series, e.g. users_monthly's, numbered by index) as long as the site's months. Values are Float64, so counts and percentages share a column.
+    """
+    frames = []
+    for site, site_out in out.items():
+        if site.startswith("_"):
+            continue
+
+        months = len(site_out["posts"])
+        start = site_out["_start_year"] * 12 + site_out["_start_month"] - 1
+        end = start + months - 1
+        df_months = pl.date_range(
+            date(start // 12, start % 12 + 1, 1),
+            date(end // 12, end % 12 + 1, 1),
+            interval="1mo",
+            eager=True,
+        ).alias("month")
+
+        for metric, value in site_out.items():
+            if isinstance(value, pl.Series):
+                series = [value]
+            elif isinstance(value, list) and all(
+                isinstance(s, pl.Series) for s in value
+            ):
+                series = value
+            else:
+                continue
+
+            for index, s in enumerate(series):
+                if len(s) != months:
+                    continue
+                frames.append(
+                    DataFrame(
+                        [
+                            df_months,
+                            s.cast(pl.Float64).alias("value"),
+                        ]
+                    ).select(
+                        site=pl.lit(site),
+                        metric=pl.lit(metric),
+                        series=pl.lit(index, pl.UInt16),
+                        month="month",
+                        value="value",
+                    )
+                )
+
+    return pl.concat(frames)
+
+
+def backfill_snapshot(
+    name: str,
+    infodump_dir: str,
+    output_dir: str,
+    file_cache_dir: str,
+    lazy: bool = False,
+    compact: bool = False,
+) -> DataFrame:
+    """
+    Calculate one snapshot's stats, write them to <name>.json in output_dir, and return them as a time series, with the snapshot's name and publication timestamp.
+    """
+    out = calculate_stats(
+        infodump_dir,
+        get_local_publication_timestamp(infodump_dir),
+        lazy=lazy,
+        compact=compact,
+        file_cache_dir=file_cache_dir,
+    )
+
+    output_path = os.path.join(output_dir, f"{name}.json")
+    print(f'Write JSON to "{output_path}"')
+    write_json(out, output_path)
+
+    return to_time_series(out).select(
+        pl.lit(name).alias("snapshot"),
+        pl.lit(out[KEY_TIMESTAMP]).alias("published"),
+        pl.all(),
+    )
+
+
+def backfill(
+    snapshots_dir: str,
+    output_dir: str,
+    workers: int = BACKFILL_WORKERS,
+    file_cache_dir: str | None = None,
+    lazy: bool = False,
+    compact: bool = False,
+) -> None:
+    """
+    Calculate stats for every Infodump snapshot in snapshots_dir (see find_snapshots), e.g. restored from the workflow's restic backups, to see how published numbers changed from one Infodump to the next.
+
+    Snapshots are calculated in a pool of worker processes, with polars' threads split between them. Parsed files are shared between snapshots in file_cache_dir (see cache_file_scan), so a file that's identical to one in an earlier snapshot, by sha256, is memory-mapped rather than parsed again. Without file_cache_dir, a temporary one in output_dir is used and removed afterwards.
+
+    Writes each snapshot's stats to <snapshot>.json in output_dir, and all of them to backfill.parquet, with a row per snapshot, site, metric, series and month (see to_time_series).
+    """
+    snapshots = find_snapshots(snapshots_dir)
+    if not snapshots:
+        print(f'No Infodump snapshots in "{snapshots_dir}"')
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    tmp_cache_dir = None
+    if file_cache_dir is None:
+        tmp_cache_dir = file_cache_dir = tempfile.mkdtemp(
+            prefix=".tmp-cache-", dir=output_dir
+        )
+
+    # workers inherit the environment, so split polars' thread pool between them
+    workers = max(1, min(workers, len(snapshots)))
+    os.environ.setdefault(
+        "POLARS_MAX_THREADS", str(max(1, (os.cpu_count() or 1) // workers))
+    )
+
+    print(f"Backfill {len(snapshots)} snapshots, {workers} at a time...")
+
+    try:
+        with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as pool:
+            futures = {
+                pool.submit(
+                    backfill_snapshot,
+                    name,
+                    infodump_dir,
+                    output_dir,
+                    file_cache_dir,
+                    lazy,
+                    compact,
+                ): name
+                for name, infodump_dir in snapshots.items()
+            }
+            results = {}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                print(f'Finished snapshot "{futures[future]}"')
+    finally:
+        if tmp_cache_dir is not None:
+            shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+
+    df = pl.concat([results[name] for name in snapshots])
+
+    parquet_path = os.path.join(output_dir, BACKFILL_PARQUET)
+    print(f'Write {df.height} rows to "{parquet_path}"')
+    df.write_parquet(parquet_path + ".part", statistics=True)
+    os.replace(parquet_path + ".part", parquet_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="calculate stats for every Infodump snapshot in a directory, e.g. restored from backups, as json per snapshot and one Parquet time series"
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=BACKFILL_WORKERS,
+        help="number of snapshots to calculate at once",
+    )
+    parser.add_argument(
+        "-c",
+        "--file-cache-dir",
+        help="share parsed Infodump files between snapshots, and between runs, in this directory (default: a temporary directory in output_dir)",
+    )
+    parser.add_argument(
+        "-l",
+        "--lazy",
+        action="store_true",
+        help="collect all stats for all sites in one go, letting polars share work between them",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="hold posts and comments in a compact schema, to use less memory per worker",
+    )
+    parser.add_argument("snapshots_dir")
+    parser.add_argument("output_dir")
+    args = parser.parse_args()
+
+    backfill(
+        args.snapshots_dir,
+        args.output_dir,
+        args.workers,
+        args.file_cache_dir,
+        args.lazy,
+        args.compact,
+    )
@@ -0,0 +1,329 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from typing import Callable
+
+import polars as pl
+from infodump_tools.calculate import (
+    calculate_for_site,
+    calculate_partials,
+    calculate_stats,
+    date_parser,
+    date_parser_strptime,
+    get_local_publication_timestamp,
+    load_dfs,
+)
+from infodump_tools.config import KEY_TIMESTAMP, SITES
+from infodump_tools.instrument import lap_timer, print_profile
+from infodump_tools.memory import get_peak_rss_mb
+from infodump_tools.output import write_json
+from infodump_tools.synthetic import generate_infodump
+from polars import DataFrame, Expr
+
+DATESTAMP_ROWS = [1_000_000, 10_000_000, 50_000_000]
+
+# either side of date_parser's enum of dates, which it parses with strptime instead
+DATESTAMP_EDGES = [
+    "Dec 31 1998 11:59:59:999PM",
+    "Jan  1 1999 12:00:00:000AM",
+    "Dec 31 2099 11:59:59:999PM",
+    "Jan  1 2100 12:00:00:000AM",
+    "Jan  2 2100 12:00:00:000AM",
+    "Jul  4 1776  1:05:03:000PM",
+]
+
+# numbers of comments in the synthetic Infodumps benchmarked by the suite
+SUITE_SCALES = [10_000, 100_000, 1_000_000]
+
+# fixed, so synthetic Infodumps, and so results, are comparable between runs
+SUITE_PUBLISHED = datetime(2026, 1, 1, 20, 0, 0)
+
+MEMORY_COMMENTS = 1_000_000
+MEMORY_BUDGET_MB = 512
+
+
+def synthetic_datestamps(rows: int, seed: int = 0) -> DataFrame:
+    """
+    A column of random datestamps in Infodump format, e.g. "Jul  4 1999  1:05:03:000PM", between July 1999 and now.
+    """
+    start = datetime(1999, 7, 1)
+    span = int((datetime.now() - start).total_seconds())
+
+    random = pl.int_range(rows, dtype=pl.UInt64).hash(seed)
+    dt = pl.lit(start) + pl.duration(seconds=random % span)
+    ms = ((random // span) % 1000).cast(pl.String).str.zfill(3)
+
+    return pl.select(
+        datestamp=pl.concat_str(
+            dt.dt.to_string("%b %e %Y %l:%M:%S:"), ms, dt.dt.to_string("%p")
+        )
+    )
+
+
+def time_best(f: Callable[[], object], repeat: int) -> float:
+    """
+    Best of `repeat` wall times of f(), in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_datestamps(rows_list: list[int], repeat: int) -> None:
+    """
+    Time date_parser against date_parser_strptime on synthetic datestamp columns, checking they agree, there and on DATESTAMP_EDGES.
+    """
+    parsers: list[Callable[[str], Expr]] = [date_parser_strptime, date_parser]
+
+    df = DataFrame({"datestamp": DATESTAMP_EDGES})
+    results = [df.select(parser("datestamp")) for parser in parsers]
+    if not results[0].equals(results[1]) or results[1].null_count().item():
+        raise ValueError(f"Parsers disagree on {DATESTAMP_EDGES}")
+
+    print(f"{'rows':>12} {parsers[0].__name__:>22} {parsers[1].__name__:>12} speedup")
+
+    for rows in rows_list:
+        df = synthetic_datestamps(rows)
+
+        results = [df.select(parser("datestamp")) for parser in parsers]
+        if not results[0].equals(results[1]):
+            raise ValueError(f"Parsers disagree on {rows} rows")
+        del results
+
+        baseline, fast = (
+            time_best(lambda: df.select(parser("datestamp")), repeat)
+            for parser in parsers
+        )
+
+        print(f"{rows:>12} {baseline:>21.3f}s {fast:>11.3f}s {baseline / fast:>6.1f}x")
+
+
+def benchmark_scale(work_dir: str, comments: int, seed: int) -> dict:
+    """
+    Benchmark the stats pipeline on a synthetic Infodump with this many comments, generating it if it isn't in work_dir already.
+
+    Times ingestion, partial aggregates, each metric of each site in calculate_for_site, and json output, with a profile of each.
+    """
+
+    infodump_dir = os.path.join(work_dir, f"synthetic_{comments}_{seed}")
+
+    profile = {}
+    lap = lap_timer(profile, "benchmark")
+
+    if not os.path.isfile(os.path.join(infodump_dir, "usernames.txt")):
+        generate_infodump(infodump_dir, comments, seed, SUITE_PUBLISHED)
+        lap("generate")
+
+    joinyears, df_users, df_posts_all, df_comments_all, df_activity_all = load_dfs(
+        infodump_dir, profile=profile
+    )
+    lap("load")
+
+    partials = calculate_partials(
+        df_users,
+        df_posts_all,
+        df_comments_all,
+        df_activity_all,
+        lazy=True,
+        profile=profile,
+    )
+    lap("partials")
+
+    out = {
+        KEY_TIMESTAMP: SUITE_PUBLISHED.isoformat(),
+        "_start_joinyear": joinyears[0],
+        **{
+            site: calculate_for_site(
+                site, joinyears, df_users, partials, profile=profile
+            )
+            for site in ["all"] + SITES
+        },
+    }
+    lap("sites")
+
+    write_json(out, os.path.join(infodump_dir, "data.json"))
+    lap("json")
+
+    return {
+        "comments": comments,
+        "seed": seed,
+        "rows": {
+            "users": df_users.height,
+            "posts": df_posts_all.height,
+            "comments": df_comments_all.height,
+        },
+        "profile": profile,
+    }
+
+
+def measure_peak_rss(infodump_dir: str, **kwargs) -> tuple[float, float]:
+    """
+    Calculate stats for infodump_dir with calculate_stats' kwargs, and return this process' peak memory in MB, and the wall time in seconds. Call it in a fresh process, as peak memory never goes down.
+    """
+    start = time.perf_counter()
+    calculate_stats(
+        infodump_dir, get_local_publication_timestamp(infodump_dir), **kwargs
+    )
+    return get_peak_rss_mb(), time.perf_counter() - start
+
+
+def benchmark_memory(
+    work_dir: str, comments: int, seed: int, memory_budget_mb: int
+) -> None:
+    """
+    Measure peak memory calculating stats for a synthetic Infodump with this many comments, by default and in streaming mode with memory_budget_mb, each in a fresh process.
+
+    Raises ValueError if streaming mode's peak is over the budget.
+    """
+
+    infodump_dir = os.path.join(work_dir, f"synthetic_{comments}_{seed}")
+    if not os.path.isfile(os.path.join(infodump_dir, "usernames.txt")):
+        generate_infodump(infodump_dir, comments, seed, SUITE_PUBLISHED)
+
+    modes = {
+        "default": {},
+        "streaming": {"streaming": True, "memory_budget_mb": memory_budget_mb},
+    }
+
+    results = {}
+    for mode, kwargs in modes.items():
+        # spawned, so each starts from an interpreter's baseline, not this one's peak
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+            results[mode] = pool.submit(
+                measure_peak_rss, infodump_dir, **kwargs
+            ).result()
+
+    print(f"{'mode':>10} {'peak':>8} {'time':>7}")
+    for mode, (peak, seconds) in results.items():
+        print(f"{mode:>10} {peak:>5.0f} MB {seconds:>6.2f}s")
+
+    peak = results["streaming"][0]
+    if peak > memory_budget_mb:
+        raise ValueError(
+            f"Streaming peaked at {peak:.0f} MB, over the memory budget of {memory_budget_mb} MB"
+        )
+    print(f"Streaming peak is within the memory budget of {memory_budget_mb} MB")
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_suite(
+    work_dir: str, scales: list[int], seed: int, output_path: str
+) -> None:
+    """
+    Benchmark the stats pipeline at each scale, and write the results as json to output_path, to track across changes.
+    """
+
+    results = []
+    for comments in scales:
+        print(f"Benchmark {comments} comments")
+        results.append(benchmark_scale(work_dir, comments, seed))
+
+        print_profile(results[-1]["profile"])
+
+    print(f'Write results to "{output_path}"')
+    with open(output_path, "w") as f:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "git_commit": get_git_commit(),
+                "python": platform.python_version(),
+                "polars": pl.__version__,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "results": results,
+            },
+            f,
+            indent=4,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_datestamps = subparsers.add_parser(
+        "datestamps", help="time date_parser against date_parser_strptime"
+    )
+    parser_datestamps.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=DATESTAMP_ROWS,
+        help="sizes of synthetic datestamp columns to parse",
+    )
+    parser_datestamps.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="time each parser this many times, and report the best",
+    )
+
+    parser_suite = subparsers.add_parser(
+        "suite", help="time the stats pipeline on synthetic Infodumps"
+    )
+    parser_suite.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=SUITE_SCALES,
+        help="numbers of comments in the synthetic Infodumps",
+    )
+    parser_suite.add_argument("--seed", type=int, default=0)
+    parser_suite.add_argument(
+        "--work-dir",
+        default="infodump_synthetic",
+        help="synthetic Infodumps are generated here, and reused by later runs",
+    )
+    parser_suite.add_argument(
+        "-o", "--output", default="benchmark.json", help="write results to this file"
+    )
+
+    parser_memory = subparsers.add_parser(
+        "memory",
+        help="check streaming mode's peak memory against a budget, on a synthetic Infodump",
+    )
+    parser_memory.add_argument(
+        "--comments",
+        type=int,
+        default=MEMORY_COMMENTS,
+        help="number of comments in the synthetic Infodump",
+    )
+    parser_memory.add_argument("--seed", type=int, default=0)
+    parser_memory.add_argument(
+        "--work-dir",
+        default="infodump_synthetic",
+        help="synthetic Infodumps are generated here, and reused by later runs",
+    )
+    parser_memory.add_argument(
+        "-m",
+        "--memory-budget",
+        type=int,
+        default=MEMORY_BUDGET_MB,
+        help="fail if streaming mode's peak memory, in MB, is over this",
+    )
+
+    args = parser.parse_args()
+
+    if args.benchmark == "datestamps":
+        benchmark_datestamps(args.rows, args.repeat)
+    elif args.benchmark == "memory":
+        benchmark_memory(args.work_dir, args.comments, args.seed, args.memory_budget)
+    else:
+        benchmark_suite(args.work_dir, args.scales, args.seed, args.output)
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Tuple
+
+import polars as pl
+from infodump_tools.config import INFODUMP_FILENAMES
+from infodump_tools.manifest import read_downloaded_file
+from infodump_tools.sources import get_source_path, open_source
+from polars import DataFrame, LazyFrame
+
+CACHE_META = "meta.json"
+CACHE_TABLES = ["users", "posts", "comments", "activity"]
+
+# bump when load_dfs changes what it produces, so old cache entries are not reused
+CACHE_VERSION = 1
+
+# fingerprints taken by this process, by source path, size and modification time, so each file is hashed once however many caches key on it
+file_fingerprints: dict[tuple[str, int, int], dict] = {}
+
+
+def fingerprint_file(infodump_dir: str, filename: str) -> dict:
+    """
+    Fingerprint an Infodump file by its first-line timestamp, and the size and sha256 of its txt file, or of its zip if it hasn't been extracted.
+
+    If the download manifest says the file is unchanged since it was downloaded (see read_downloaded_file), the downloaded zip's sha256 stands in for the file's, as zip_sha256, so it isn't read in full.
+
+    Remembered for the rest of the process, while the file's size and modification time are unchanged.
+    """
+    path = get_source_path(infodump_dir, filename)
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in file_fingerprints:
+        return file_fingerprints[memo_key]
+
+    with open_source(infodump_dir, filename) as f:
+        timestamp = f.readline().strip().decode("utf-8")
+
+    entry = read_downloaded_file(infodump_dir, filename)
+    if entry is not None:
+        fingerprint = {
+            "timestamp": timestamp,
+            "size": stat.st_size,
+            "zip_sha256": entry["sha256"],
+        }
+    else:
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        fingerprint = {"timestamp": timestamp, "size": stat.st_size, "sha256": digest}
+
+    file_fingerprints[memo_key] = fingerprint
+    return fingerprint
+
+
+def fingerprint_sources(infodump_dir: str) -> dict[str, dict]:
+    return {
+        filename: fingerprint_file(infodump_dir, filename)
+        for filename in INFODUMP_FILENAMES
+    }
+
+
+def get_cache_key(sources: dict[str, dict]) -> str:
+    """
+    Cache key covering every source file plus the cache version and polars version.
+    """
+    payload = json.dumps(
+        {"version": CACHE_VERSION, "polars": pl.__version__, "sources": sources},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def get_file_cache_path(file_cache_dir: str, filename: str, fingerprint: dict) -> str:
+    key = get_cache_key({filename: fingerprint})
+    return os.path.join(file_cache_dir, f"{filename}.{key}.arrow")
+
+
+def evict_file_cache(file_cache_dir: str, sources: dict[str, dict]) -> None:
+    """
+    Remove every parsed file from file_cache_dir except those of sources, for a per-file cache that only ever needs the current Infodump.
+    """
+    keep = {
+        os.path.basename(get_file_cache_path(file_cache_dir, filename, fingerprint))
+        for filename, fingerprint in sources.items()
+    }
+    for name in os.listdir(file_cache_dir):
+        if name.endswith(".arrow") and name not in keep:
+            print(f'Evict parsed file "{name}"')
+            os.remove(os.path.join(file_cache_dir, name))
+
+
+def cache_file_scan(
+    lf: LazyFrame, infodump_dir: str, filename: str, file_cache_dir: str | None
+) -> LazyFrame:
+    """
+    A parsed Infodump file, from file_cache_dir if an identical file (by fingerprint) has been parsed before, else parsed now and written there. Returns lf as it is if file_cache_dir is None.
+
+    For sharing parsed files between Infodump snapshots, e.g. in a backfill, where most files are often unchanged from one snapshot to the next. Unlike load_dfs's cache, entries are per file, and only evicted by evict_file_cache. Each is written to a temporary file and renamed into place, so several processes can share the directory.
+    """
+    if file_cache_dir is None:
+        return lf
+
+    path = get_file_cache_path(
+        file_cache_dir, filename, fingerprint_file(infodump_dir, filename)
+    )
+
+    if not os.path.isfile(path):
+        os.makedirs(file_cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=file_cache_dir)
+        os.close(fd)
+        try:
+            lf.collect().write_ipc(tmp_path, compression="uncompressed")
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    return pl.scan_ipc(path, memory_map=True)
+
+
+def read_cache(
+    cache_dir: str, key: str
+) -> Tuple[list[int], DataFrame, DataFrame, DataFrame, DataFrame] | None:
+    """
+    Read a cache entry, memory-mapping the Arrow IPC files. Returns None on a miss.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+
+    try:
+        with open(os.path.join(entry_dir, CACHE_META)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    dfs = [
+        pl.read_ipc(os.path.join(entry_dir, f"{table}.arrow"), memory_map=True)
+        for table in CACHE_TABLES
+    ]
+
+    return (meta["joinyears"], *dfs)
+
+
+def write_cache(
+    cache_dir: str,
+    key: str,
+    sources: dict[str, dict],
+    joinyears: list[int],
+    *dfs: DataFrame,
+) -> None:
+    """
+    Write a cache entry, then evict all other entries.
+
+    The entry is written to a temporary directory and renamed into place, so an interrupted write never leaves a half-populated entry behind.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+
+    try:
+        for table, df in zip(CACHE_TABLES, dfs):
+            # uncompressed, so the files can be memory-mapped on read
+            df.write_ipc(
+                os.path.join(tmp_dir, f"{table}.arrow"), compression="uncompressed"
+            )
+
+        with open(os.path.join(tmp_dir, CACHE_META), "w") as f:
+            json.dump({"joinyears": joinyears, "sources": sources}, f, indent=4)
+
+        os.rename(tmp_dir, os.path.join(cache_dir, key))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    evict_cache(cache_dir, keep=key)
+
+
+def evict_cache(cache_dir: str, keep: str) -> None:
+    """
+    Remove every cache entry except `keep`. Only one Infodump is current at a time.
+    """
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name != keep and os.path.isdir(path):
+            print(f'Evict cache entry "{name}"')
+            shutil.rmtree(path)
@@ -1,23 +1,37 @@
-import os
-from datetime import date, datetime
-from typing import Tuple
+from datetime import date, datetime, time
+from typing import Callable, Tuple
 from zoneinfo import ZoneInfo
 
 import polars as pl
+from infodump_tools.cache import (
+    cache_file_scan,
+    fingerprint_sources,
+    get_cache_key,
+    read_cache,
+    write_cache,
+)
 from infodump_tools.config import (
     ACTIVITY_LEVELS,
+    ACTIVITY_QUANTILES,
     AGE_THRESHOLDS,
     INFODUMP_FILE_TIMESTAMP_TZ,
     INFODUMP_FILENAMES,
     INFODUMP_TZ,
     KEY_TIMESTAMP,
+    ROLLING_WINDOWS,
     SITES,
+    THREAD_SIZES,
     TOP_N,
 )
+from infodump_tools.instrument import count_values, lap_timer, record_plans
+from infodump_tools.memory import report_peak_rss, set_streaming_budget
+from infodump_tools.sources import get_source_path, open_source, read_source
+from infodump_tools.timezones import hour, local_to_utc, utc_to_local, weekday
 from polars import (
     DataFrame,
     Enum,
     Expr,
+    LazyFrame,
     String,
     UInt16,
     UInt8,
@@ -26,13 +40,52 @@ from polars import (
     lit,
 )
 
+# partial aggregates are grouped by these, so stats for any site, or for all sites, can be derived from them
+PARTIAL_KEYS = ["site", "month"]
+
+# every ISO weekday (Monday is 1) and hour, in order, so weekday by hour counts are complete matrices
+WEEKDAY_HOURS = DataFrame(
+    {"weekday": pl.int_range(1, 8, dtype=UInt8, eager=True)}
+).join(DataFrame({"hour": pl.int_range(0, 24, dtype=UInt8, eager=True)}), how="cross")
+
+# sketches of per-user monthly activity have a bucket for each count below ACTIVITY_SKETCH_EXACT, and ACTIVITY_SKETCH_OCTAVE_BUCKETS
+# buckets per doubling above it. so ACTIVITY_LEVELS' thresholds, which are below it, are exact, and larger counts are within about 4.4%
+ACTIVITY_SKETCH_EXACT = 64
+ACTIVITY_SKETCH_EXACT_OCTAVES = 6  # log2(ACTIVITY_SKETCH_EXACT)
+ACTIVITY_SKETCH_OCTAVE_BUCKETS = 8
+
+# quantiles of months with at most this many active users are exact, from their sorted counts, rather than from their sketch
+ACTIVITY_QUANTILES_EXACT_USERS = 1000
+
+# engines for distinct users over rolling windows of months: exact, or estimated with HyperLogLog sketches
+ROLLING_USERS = ["exact", "hll"]
+
+# HyperLogLog sketches of distinct users have 2 ** HLL_PRECISION registers
+HLL_PRECISION = 12
+HLL_SEED = 0
+
+# ages are binned by whole months of account age, so AGE_THRESHOLDS' edges in years fall on month boundaries exactly
+AGE_MONTH_DAYS = 365.25 / 12
+
 
 def read_file_timestamp(infodump_dir: str, filename: str) -> datetime:
     """
-    Read the timestamp from the first line of an Infodump txt file.
+    Read the timestamp from the first line of an Infodump txt file, extracted or zipped.
     """
-    with open(os.path.join(infodump_dir, f"{filename}.txt")) as f:
-        return datetime.strptime(f.readline().strip(), "%a %b %d %H:%M:%S %Y")
+    with open_source(infodump_dir, filename) as f:
+        return datetime.strptime(
+            f.readline().decode("utf-8").strip(), "%a %b %d %H:%M:%S %Y"
+        )
+
+
+def get_local_publication_timestamp(infodump_dir: str) -> str:
+    """
+    Stand-in for the Infodump's publication timestamp, which is only on its homepage, from local files: their newest first-line timestamp, formatted as download.get_publication_timestamp's.
+    """
+    newest = max(
+        read_file_timestamp(infodump_dir, filename) for filename in INFODUMP_FILENAMES
+    )
+    return newest.strftime("%-d %B %Y %H:%M")
 
 
 def convert_tz(dt: datetime, from_tz: str, to_tz: str) -> datetime:
@@ -46,15 +99,78 @@ def convert_tz(dt: datetime, from_tz: str, to_tz: str) -> datetime:
     )
 
 
+# fixed-width Infodump datestamps, e.g. "Jul  4 1999  1:05:03:000PM", are decoded by looking up their fields in these enums.
+# the physical value of a field is then its offset: days since DATESTAMP_EPOCH, and seconds since 12 o'clock
+DATESTAMP_EPOCH = date(1999, 1, 1)
+DATESTAMP_EPOCH_SECONDS = int((DATESTAMP_EPOCH - date(1970, 1, 1)).total_seconds())
+
+DATESTAMP_DAYS = Enum(
+    pl.date_range(DATESTAMP_EPOCH, date(2100, 1, 1), eager=True).dt.to_string(
+        "%b %e %Y"
+    )
+)
+
+DATESTAMP_TIMES = Enum(
+    [
+        f"{hour:>2}:{minute:02}:{second:02}"
+        for hour in [12, *range(1, 12)]
+        for minute in range(60)
+        for second in range(60)
+    ]
+)
+
+
 def date_parser(col_name: str) -> Expr:
     """
     Parse Infodump datestamp column to a polars datetime.
 
-    Remove fractional seconds, as polars chokes on them.
+    Datestamps are fixed width, so rather than parse each one with strptime, cast the date ("Jul  4 1999") and time (" 1:05:03") fields to enums of every possible value, and add up their offsets. Around twice as fast as date_parser_strptime, with identical results. Fractional seconds are dropped.
+
+    Dates outside DATESTAMP_DAYS' range, 1999 to 2100, aren't in the enum, so just those are parsed with strptime instead, as dates. Times are always in DATESTAMP_TIMES.
 
     The infodump datestamp column is in Mefi server time, America/Los_Angeles.
 
-    But we store a timezone-naive datetime, because supplying timezone="America/Los_Angeles" causes ComputeErrors about impossible timestamps at DST transitions.
+    But we store a timezone-naive datetime, because supplying timezone="America/Los_Angeles" causes ComputeErrors about impossible timestamps at DST transitions. Where UTC is needed, timezones.local_to_utc converts them with explicit rules for those timestamps.
+    """
+    # null for dates outside the enum's range
+    enum_days = (
+        col(col_name)
+        .str.head(11)
+        .cast(DATESTAMP_DAYS, strict=False)
+        .to_physical()
+        .cast(pl.Int64)
+    )
+    # strptime only sees those dates, the rest are null. without its cache, nulls cost next to nothing
+    strptime_days = (
+        pl.when(enum_days.is_null())
+        .then(col(col_name).str.head(11))
+        .str.to_date("%b %e %Y", cache=False)
+        - DATESTAMP_EPOCH
+    ).dt.total_days()
+    days = pl.coalesce(enum_days, strptime_days)
+    seconds = col(col_name).str.slice(12, 8).cast(DATESTAMP_TIMES).to_physical()
+    pm = col(col_name).str.ends_with("PM")
+
+    return (
+        (
+            (
+                DATESTAMP_EPOCH_SECONDS
+                + days * 86400
+                + seconds.cast(pl.Int64)
+                + pm.cast(pl.Int64) * 43200
+            )
+            * 1000
+        )
+        .cast(pl.Datetime("ms"))
+        .alias(col_name)
+    )
+
+
+def date_parser_strptime(col_name: str) -> Expr:
+    """
+    Parse Infodump datestamp column to a polars datetime, with strptime. Slower than date_parser, which uses it for dates outside its enum's range.
+
+    Remove fractional seconds, as polars chokes on them.
     """
     return pl.concat_str(
         col(col_name).str.head(20), col(col_name).str.slice(-2, 2)
@@ -69,7 +185,97 @@ def extract_month(col_name: str) -> Expr:
     return pl.date(col(col_name).dt.year(), col(col_name).dt.month(), 1)
 
 
-def get_cutoff_date(infodump_dir: str, df_comments_all: DataFrame) -> date:
+# compact schema, for less memory and faster group-bys: posts' and comments' datestamps are seconds since DATESTAMP_EPOCH,
+# and months are an index of months since DATESTAMP_EPOCH's month
+def to_compact_seconds(col_name: str) -> Expr:
+    return (
+        (col(col_name) - pl.lit(datetime.combine(DATESTAMP_EPOCH, time())))
+        .dt.total_seconds()
+        .cast(UInt32)
+        .alias(col_name)
+    )
+
+
+def from_compact_seconds(col_name: str) -> Expr:
+    return (
+        ((col(col_name).cast(pl.Int64) + DATESTAMP_EPOCH_SECONDS) * 1000)
+        .cast(pl.Datetime("ms"))
+        .alias(col_name)
+    )
+
+
+def to_age_months(years: float) -> int:
+    """
+    An age bin edge in years, as whole months of AGE_MONTH_DAYS. Edges must fall on a month.
+    """
+    months = round(years * 12)
+    if abs(years * 12 - months) > 1e-9:
+        raise ValueError(f"Age bin edge {years} is not a whole number of months")
+    return months
+
+
+def check_age_bins(edges: list[float]) -> None:
+    """
+    Raise ValueError unless age bin edges, in years, are at least two, increasing, and each on a whole month.
+    """
+    months = [to_age_months(edge) for edge in edges]
+    if len(months) < 2 or months != sorted(set(months)):
+        raise ValueError(f"Age bin edges {edges} are not at least two increasing edges")
+
+
+def get_bin(values: Expr, edges: list[int]) -> Expr:
+    """
+    Index of the bin, closed on the left, that each of values falls in, by a binary search of the edges. -1 if it's below the first edge, at or above the last, or null.
+    """
+    if edges != sorted(set(edges)):
+        raise ValueError(f"Bin edges {edges} are not increasing")
+
+    i = (
+        pl.lit(pl.Series(edges, dtype=pl.Int64))
+        .search_sorted(values.cast(pl.Int64), side="right")
+        .cast(pl.Int32)
+        - 1
+    )
+    return pl.when(i < len(edges) - 1).then(i).otherwise(-1)
+
+
+def get_age_bin(age_months: Expr, edges: list[float]) -> Expr:
+    """
+    Index of the bin that each of age_months falls in, as get_bin, with edges in years.
+    """
+    return get_bin(age_months, [to_age_months(years) for years in edges])
+
+
+def to_month_index(month: date) -> int:
+    return (month.year - DATESTAMP_EPOCH.year) * 12 + month.month - 1
+
+
+def to_compact_month(col_name: str) -> Expr:
+    return (
+        (
+            (col(col_name).dt.year() - DATESTAMP_EPOCH.year) * 12
+            + col(col_name).dt.month()
+            - 1
+        )
+        .cast(UInt16)
+        .alias(col_name)
+    )
+
+
+def from_compact_month(col_name: str) -> Expr:
+    return pl.date(
+        DATESTAMP_EPOCH.year + col(col_name) // 12, col(col_name) % 12 + 1, 1
+    ).alias(col_name)
+
+
+def to_compact(df: DataFrame | LazyFrame) -> DataFrame | LazyFrame:
+    """
+    Convert posts or comments to the compact schema.
+    """
+    return df.with_columns(to_compact_seconds("datestamp"), to_compact_month("month"))
+
+
+def get_cutoff_date(infodump_dir: str, df_comments_all: DataFrame | LazyFrame) -> date:
     """
     We don't want to show months with incomplete data. Returns the first day we want to exclude.
 
@@ -116,94 +322,192 @@ def get_cutoff_date(infodump_dir: str, df_comments_all: DataFrame) -> date:
 
 def load_dfs(
     infodump_dir: str,
-) -> Tuple[list[int], DataFrame, DataFrame, DataFrame, DataFrame]:
+    *,
+    cache_dir: str | None = None,
+    streaming: bool = False,
+    memory_budget_mb: int | None = None,
+    profile: dict | None = None,
+    compact: bool = False,
+    file_cache_dir: str | None = None,
+) -> Tuple[list[int], DataFrame, DataFrame, DataFrame, DataFrame | LazyFrame]:
     """
-    Load posts, comments, and users data from Infodump txt files into polars DataFrames.
+    Load posts, comments, and users data from Infodump txt files into polars DataFrames. Files that haven't been extracted are read straight from their zips.
+
+    If cache_dir is given, the finished DataFrames are cached there as Arrow IPC, keyed by each source file's timestamp, size and hash. Unchanged files are then memory-mapped from the cache instead of parsed.
+
+    If streaming is set, use scan_dfs instead, which bounds peak memory. The cache isn't used in streaming mode.
+
+    If compact is set, posts and comments use the compact schema (see to_compact), and activity is a LazyFrame over them rather than a copy. Cached tables are converted as they're loaded.
+
+    If file_cache_dir is given, each parsed file is also kept there, keyed by its own fingerprint (see cache_file_scan), so files unchanged between Infodumps are only parsed once. It isn't used in streaming mode.
+
+    If profile is given, record each load step in it.
     """
 
-    print("Load posts")
+    if streaming:
+        return scan_dfs(infodump_dir, memory_budget_mb, profile, compact)
+
+    if cache_dir is None:
+        return parse_dfs(infodump_dir, profile, compact, file_cache_dir)
+
+    lap = lap_timer(profile, "load")
+
+    sources = fingerprint_sources(infodump_dir)
+    key = get_cache_key(sources)
+
+    lap("fingerprint")
+
+    cached = read_cache(cache_dir, key)
+    if cached is not None:
+        print(f'Load from cache "{key}"')
+        lap("read_cache", rows_out=sum(df.height for df in cached[1:]))
+        return compact_dfs(*cached) if compact else cached
+
+    dfs = parse_dfs(infodump_dir, profile, file_cache_dir=file_cache_dir)
+
+    lap = lap_timer(profile, "load")
+
+    print(f'Write cache "{key}"')
+    write_cache(cache_dir, key, sources, *dfs)
+
+    lap("write_cache", rows_in=sum(df.height for df in dfs[1:]))
+
+    return compact_dfs(*dfs) if compact else dfs
+
+
+def compact_dfs(
+    joinyears: list[int],
+    df_users: DataFrame,
+    df_posts_all: DataFrame,
+    df_comments_all: DataFrame,
+    df_activity_all: DataFrame | LazyFrame,
+) -> Tuple[list[int], DataFrame, DataFrame, DataFrame, LazyFrame]:
+    """
+    Convert loaded tables to the compact schema, with activity as a LazyFrame over posts and comments.
+    """
+    df_posts_all = to_compact(df_posts_all)
+    df_comments_all = to_compact(df_comments_all)
+    return (
+        joinyears,
+        df_users,
+        df_posts_all,
+        df_comments_all,
+        get_activity(df_posts_all.lazy(), df_comments_all.lazy()),
+    )
+
 
-    df_posts_all = pl.concat(
+def scan_posts(infodump_dir: str, file_cache_dir: str | None = None) -> LazyFrame:
+    return pl.concat(
         [
-            pl.read_csv(
-                source=os.path.join(infodump_dir, f"postdata_{site}.txt"),
-                separator="\t",
-                skip_rows=1,
-                schema_overrides={
-                    "postid": UInt32,
-                    "userid": UInt32,
-                    "datestamp": String,
-                    "category": UInt8,
-                    "comments": UInt16,
-                    "favorites": UInt16,
-                    "deleted": UInt8,
-                    "reason": String,
-                },
-                null_values=["[NULL]"],  # reason defaults to "[NULL]"
-            )
-            .rename({"favorites": "faves"})  # consistent columm names
-            .with_columns(
-                date_parser("datestamp"),
-                site=lit(site, Enum(SITES)),
+            cache_file_scan(
+                pl.scan_csv(
+                    source=read_source(infodump_dir, f"postdata_{site}"),
+                    separator="\t",
+                    skip_rows=1,
+                    schema_overrides={
+                        "postid": UInt32,
+                        "userid": UInt32,
+                        "datestamp": String,
+                        "category": UInt8,
+                        "comments": UInt16,
+                        "favorites": UInt16,
+                        "deleted": UInt8,
+                        "reason": String,
+                    },
+                    null_values=["[NULL]"],  # reason defaults to "[NULL]"
+                )
+                .rename({"favorites": "faves"})  # consistent columm names
+                .with_columns(
+                    date_parser("datestamp"),
+                    site=lit(site, Enum(SITES)),
+                )
+                .with_columns(month=extract_month("datestamp"))
+                .filter(
+                    ~((col("site") == "meta") & (col("category") == 10))
+                ),  # exclude early AskMes stored in MeTa table
+                infodump_dir,
+                f"postdata_{site}",
+                file_cache_dir,
             )
-            .with_columns(month=extract_month("datestamp"))
-            .filter(
-                ~((col("site") == "meta") & (col("category") == 10))
-            )  # exclude early AskMes stored in MeTa table
             for site in SITES
         ]
-    ).sort("datestamp")
+    )
 
-    print("Load comments")
 
-    df_comments_all = pl.concat(
+def scan_comments(infodump_dir: str, file_cache_dir: str | None = None) -> LazyFrame:
+    return pl.concat(
         [
-            pl.read_csv(
-                source=os.path.join(infodump_dir, f"commentdata_{site}.txt"),
-                separator="\t",
-                skip_rows=1,
-                schema_overrides={
-                    "commentid": UInt32,
-                    "postid": UInt32,
-                    "userid": UInt32,
-                    "datestamp": String,
-                    "faves": UInt16,
-                    "best answer?": UInt8,
-                },
-            )
-            .rename({"best answer?": "best"})
-            .with_columns(
-                date_parser("datestamp"),
-                site=lit(site, Enum(SITES)),
+            cache_file_scan(
+                pl.scan_csv(
+                    source=read_source(infodump_dir, f"commentdata_{site}"),
+                    separator="\t",
+                    skip_rows=1,
+                    schema_overrides={
+                        "commentid": UInt32,
+                        "postid": UInt32,
+                        "userid": UInt32,
+                        "datestamp": String,
+                        "faves": UInt16,
+                        "best answer?": UInt8,
+                    },
+                )
+                .rename({"best answer?": "best"})
+                .with_columns(
+                    date_parser("datestamp"),
+                    site=lit(site, Enum(SITES)),
+                )
+                .with_columns(month=extract_month("datestamp")),
+                infodump_dir,
+                f"commentdata_{site}",
+                file_cache_dir,
             )
-            .with_columns(month=extract_month("datestamp"))
             for site in SITES
         ]
-    ).sort("datestamp")
+    )
+
 
-    df_activity_all = pl.concat(
+def scan_users(infodump_dir: str, file_cache_dir: str | None = None) -> LazyFrame:
+    return cache_file_scan(
+        pl.scan_csv(
+            source=read_source(infodump_dir, "usernames"),
+            separator="\t",
+            skip_rows=1,
+            schema_overrides={"userid": UInt32, "joindate": String, "name": String},
+        ).with_columns(date_parser("joindate")),
+        infodump_dir,
+        "usernames",
+        file_cache_dir,
+    )
+
+
+def get_activity(
+    df_posts: DataFrame | LazyFrame, df_comments: DataFrame | LazyFrame
+) -> DataFrame | LazyFrame:
+    """
+    Posts and comments together, as generic activity.
+    """
+    return pl.concat(
         [
             df.select(col("datestamp"), col("month"), col("site"), col("userid"))
-            for df in [df_posts_all, df_comments_all]
+            for df in [df_posts, df_comments]
         ]
-    ).sort("datestamp")
+    )
 
-    print("Load users")
 
-    df_users = pl.read_csv(
-        source=os.path.join(infodump_dir, "usernames.txt"),
-        separator="\t",
-        skip_rows=1,
-        schema_overrides={"userid": UInt32, "joindate": String, "name": String},
-    ).with_columns(date_parser("joindate"))
+def complete_users(
+    df_users: DataFrame, df_first_activity: DataFrame
+) -> Tuple[list[int], DataFrame]:
+    """
+    Fix up users from their first activity (userid, datestamp of first post or comment), and add join year and month.
+
+    Returns the range of join years, and the users.
+    """
 
     # if first post or comment is earlier than user joindate, overwrite joindate.
     # should only affect 70-ish 1999 users, plus a couple of stray later accounts.
     df_users = (
         df_users.join(
-            df_activity_all.select("userid", "datestamp").unique(
-                "userid", keep="first"
-            ),
+            df_first_activity,
             on="userid",
             how="left",
             coalesce=True,
@@ -218,11 +522,7 @@ def load_dfs(
 
     # a small number of users made posts/comments but are not in df_users. create records for them, using date of first post/comment as joindate
     df_users.extend(
-        df_activity_all.select("userid", "datestamp")
-        .join(df_users, on="userid", how="anti")
-        .sort("datestamp")
-        .unique("userid", keep="first")
-        .select(
+        df_first_activity.join(df_users, on="userid", how="anti").select(
             col("userid"),
             joindate=col("datestamp"),
             name=None,
@@ -242,13 +542,88 @@ def load_dfs(
         )
     )
 
+    return joinyears, df_users
+
+
+def parse_dfs(
+    infodump_dir: str,
+    profile: dict | None = None,
+    compact: bool = False,
+    file_cache_dir: str | None = None,
+) -> Tuple[list[int], DataFrame, DataFrame, DataFrame, DataFrame | LazyFrame]:
+    """
+    Parse posts, comments, and users data from Infodump txt files into polars DataFrames.
+
+    If compact is set, posts and comments are converted to the compact schema as they're parsed, and activity is a LazyFrame over them.
+
+    If file_cache_dir is given, read each file from there if it has been parsed before (see cache_file_scan).
+    """
+
+    lap = lap_timer(profile, "load")
+
+    print("Load posts")
+
+    lf_posts = scan_posts(infodump_dir, file_cache_dir)
+    df_posts_all = (to_compact(lf_posts) if compact else lf_posts).collect()
+    df_posts_all = df_posts_all.sort("datestamp")
+
+    lap("posts", rows_out=df_posts_all.height)
+
+    print("Load comments")
+
+    lf_comments = scan_comments(infodump_dir, file_cache_dir)
+    df_comments_all = (to_compact(lf_comments) if compact else lf_comments).collect()
+    df_comments_all = df_comments_all.sort("datestamp")
+
+    lap("comments", rows_out=df_comments_all.height)
+
+    if compact:
+        df_activity_all = get_activity(df_posts_all.lazy(), df_comments_all.lazy())
+        df_first_activity = (
+            df_activity_all.group_by("userid")
+            .agg(col("datestamp").min())
+            .with_columns(from_compact_seconds("datestamp"))
+            .collect()
+        )
+    else:
+        df_activity_all = get_activity(df_posts_all, df_comments_all).sort("datestamp")
+        df_first_activity = df_activity_all.select("userid", "datestamp").unique(
+            "userid", keep="first"
+        )
+
+    lap(
+        "activity",
+        df_posts_all.height + df_comments_all.height,
+        df_first_activity.height if compact else df_activity_all.height,
+    )
+
+    print("Load users")
+
+    joinyears, df_users = complete_users(
+        scan_users(infodump_dir, file_cache_dir).collect(), df_first_activity
+    )
+
+    lap("users", rows_out=df_users.height)
+
     print("Filter out incomplete months...")
 
     cutoff_date = get_cutoff_date(infodump_dir, df_comments_all)
+    cutoff_month = to_month_index(cutoff_date) if compact else cutoff_date
+
+    rows_in = df_posts_all.height + df_comments_all.height
 
-    df_posts_all = df_posts_all.filter(col("month") < cutoff_date)
-    df_comments_all = df_comments_all.filter(col("month") < cutoff_date)
-    df_activity_all = df_activity_all.filter(col("month") < cutoff_date)
+    df_posts_all = df_posts_all.filter(col("month") < cutoff_month)
+    df_comments_all = df_comments_all.filter(col("month") < cutoff_month)
+
+    if compact:
+        df_activity_all = get_activity(df_posts_all.lazy(), df_comments_all.lazy())
+        rows_out = df_posts_all.height + df_comments_all.height
+    else:
+        rows_in += df_activity_all.height
+        df_activity_all = df_activity_all.filter(col("month") < cutoff_month)
+        rows_out = df_posts_all.height + df_comments_all.height + df_activity_all.height
+
+    lap("filter_incomplete_months", rows_in, rows_out)
 
     return (
         joinyears,
@@ -259,7 +634,99 @@ def load_dfs(
     )
 
 
-def filter_df_by_site(site, df: DataFrame) -> DataFrame:
+def scan_dfs(
+    infodump_dir: str,
+    memory_budget_mb: int | None = None,
+    profile: dict | None = None,
+    compact: bool = False,
+) -> Tuple[list[int], DataFrame, DataFrame, DataFrame, LazyFrame]:
+    """
+    Like parse_dfs, but bounds peak memory, for small machines:
+    - tables are read with the polars streaming engine, in chunks sized to memory_budget_mb if given (see set_streaming_budget)
+    - columns no stat reads (posts' category, comments and reason) are dropped at scan time
+    - incomplete months are filtered out during the scan, not after it
+    - users' first activity is aggregated in the same pass over the files
+    - activity is returned as a LazyFrame over posts and comments, not a third copy of them
+    - nothing is sorted
+    - if compact is set, posts and comments are converted to the compact schema during the scan
+
+    Logs peak memory, and warns if loading alone is over memory_budget_mb, as the budget can't be met then.
+
+    Zipped files are rejected: they'd have to be decompressed into memory whole (see read_source), which defeats the point.
+    """
+
+    zipped = [
+        filename
+        for filename in INFODUMP_FILENAMES
+        if get_source_path(infodump_dir, filename).endswith(".zip")
+    ]
+    if zipped:
+        raise ValueError(
+            f"Streaming needs extracted txt files, but these are only zipped: {', '.join(zipped)}"
+        )
+
+    lap = lap_timer(profile, "load")
+
+    if memory_budget_mb is not None:
+        set_streaming_budget(memory_budget_mb)
+
+    lf_posts = scan_posts(infodump_dir).drop("category", "comments", "reason")
+    lf_comments = scan_comments(infodump_dir)
+
+    print("Filter out incomplete months...")
+
+    cutoff_date = get_cutoff_date(infodump_dir, lf_comments)
+
+    print("Stream posts, comments and users")
+
+    lf_posts_complete = lf_posts.filter(col("month") < cutoff_date)
+    lf_comments_complete = lf_comments.filter(col("month") < cutoff_date)
+
+    queries = {
+        "posts": to_compact(lf_posts_complete) if compact else lf_posts_complete,
+        "comments": (
+            to_compact(lf_comments_complete) if compact else lf_comments_complete
+        ),
+        # first activity must include incomplete months, as in parse_dfs
+        "first_activity": get_activity(lf_posts, lf_comments)
+        .group_by("userid")
+        .agg(col("datestamp").min()),
+        "users": scan_users(infodump_dir),
+    }
+
+    lap("cutoff")
+
+    record_plans(profile, {f"load_{key}": lf for key, lf in queries.items()})
+
+    # collected together, so each file is only scanned once
+    df_posts_all, df_comments_all, df_first_activity, df_users = pl.collect_all(
+        queries.values(), engine="streaming"
+    )
+
+    lap(
+        "stream",
+        rows_out=df_posts_all.height + df_comments_all.height + df_users.height,
+    )
+
+    joinyears, df_users = complete_users(df_users, df_first_activity)
+
+    lap("users", df_first_activity.height, df_users.height)
+
+    if not report_peak_rss("loading", memory_budget_mb):
+        print(
+            "The budget can't be met: the loaded tables stay in memory while aggregating. Add --compact, or raise it"
+        )
+
+    return (
+        joinyears,
+        df_users,
+        df_posts_all,
+        df_comments_all,
+        get_activity(df_posts_all.lazy(), df_comments_all.lazy()),
+    )
+
+
+def filter_df_by_site(site, df: DataFrame | LazyFrame) -> DataFrame | LazyFrame:
     return df if site == "all" else df.filter(col("site") == site)
 
 
@@ -304,279 +771,1128 @@ def get_dfs_for_site(
     return df_posts, df_comments, df_activity, df_months
 
 
-def calculate_for_site(
-    site: str,
-    joinyears: list[int],
+def get_activity_partial_queries(
     df_users: DataFrame,
-    df_posts_all: DataFrame,
-    df_comments_all: DataFrame,
-    df_activity_all: DataFrame,
-) -> dict:
-    """
-    Calculate stats for a given site.
-
-    Returns a dictionary to be output as json.
+    df_posts: DataFrame,
+    df_comments: DataFrame,
+    df_activity: DataFrame | LazyFrame,
+    compact: bool = False,
+    clock_tz: str | None = None,
+) -> dict[str, LazyFrame]:
     """
+    Queries for partial aggregates per (site, month), from which the activity stats for any site, or for all sites, can be derived:
+    - user_months: posts and comments per user. Also gives each user's first and last month
+    - ages: activity by the user's account age in whole months (see AGE_MONTH_DAYS), to be binned by any edges with get_age_bin
+    - clock: activity per ISO weekday and hour, as integers
 
-    print(f'Calculate stats for "{site}"')
+    Each groups by site, so scans its input once for all sites.
 
-    (
-        df_posts,
-        df_comments,
-        df_activity,
-        df_months,
-    ) = get_dfs_for_site(site, df_posts_all, df_comments_all, df_activity_all)
+    If compact is set, the inputs use the compact schema, and so do the partials' months.
 
-    start_date = df_months.get_column("month").first()
-    out = {
-        "_start_year": start_date.year,
-        "_start_month": start_date.month,
-    }
+    If clock_tz is given, clock also has activity's weekday and hour in that timezone, as weekday_tz and hour_tz. Datestamps are converted from INFODUMP_TZ with a lookup in its table of UTC offset transitions.
+    """
 
-    df_users_monthly = (
-        df_months.join(
-            df_activity.select("userid", "month"),
-            on="month",
-            how="left",
-            coalesce=True,
+    if compact:
+        joindate = to_compact_seconds("joindate")
+        # whole days, truncated as Duration.total_days() does
+        age = ((col("datestamp").cast(pl.Int64) - col("joindate")) / 86400).cast(
+            pl.Int64
         )
-        .group_by(["month", "userid"], maintain_order=True)
-        .agg(count=col("userid").count())
-    )
+        local_seconds = col("datestamp").cast(pl.Int64) + DATESTAMP_EPOCH_SECONDS
+        clock_keys = {"weekday": weekday(local_seconds), "hour": hour(local_seconds)}
+    else:
+        joindate = col("joindate")
+        age = (col("datestamp") - col("joindate")).dt.total_days()
+        local_seconds = col("datestamp").dt.epoch("s")
+        clock_keys = {
+            "weekday": col("datestamp").dt.weekday().cast(UInt8),
+            "hour": col("datestamp").dt.hour().cast(UInt8),
+        }
 
-    df_users_monthly_by_activity_level = (
-        df_users_monthly.group_by("month")
-        .agg(
-            (
-                col("count").filter(col("count") >= level).count().alias(str(level))
-                for level in ACTIVITY_LEVELS
-            )
+    if clock_tz is not None:
+        tz_seconds = utc_to_local(local_to_utc(local_seconds, INFODUMP_TZ), clock_tz)
+        clock_keys["weekday_tz"] = weekday(tz_seconds)
+        clock_keys["hour_tz"] = hour(tz_seconds)
+
+    lf_user_months = (
+        pl.concat(
+            [
+                df_posts.lazy().select(
+                    *PARTIAL_KEYS,
+                    "userid",
+                    posts=lit(1, UInt32),
+                    comments=lit(0, UInt32),
+                ),
+                df_comments.lazy().select(
+                    *PARTIAL_KEYS,
+                    "userid",
+                    posts=lit(0, UInt32),
+                    comments=lit(1, UInt32),
+                ),
+            ]
         )
-        .drop("month")
+        .group_by(*PARTIAL_KEYS, "userid")
+        .agg(col("posts").sum(), col("comments").sum())
     )
 
-    out["users_monthly"] = [
-        c.to_list() for c in df_users_monthly_by_activity_level.get_columns()
-    ]
-
-    df_users_monthly_by_joined = (
-        df_users_monthly.join(
-            df_users.select("userid", "joinyear"),
+    lf_ages = (
+        df_activity.lazy()
+        .select(*PARTIAL_KEYS, "userid", "datestamp")
+        .join(
+            df_users.lazy().select("userid", joindate),
             on="userid",
             how="left",
             coalesce=True,
         )
-        .group_by("month")
-        .agg(
-            (
-                col("joinyear").filter(joinyear=year).count().alias(str(year))
-                for year in joinyears
-            ),
+        # users missing from the users table have no age
+        .filter(col("joindate").is_not_null())
+        .group_by(
+            *PARTIAL_KEYS, age_months=(age / AGE_MONTH_DAYS).floor().cast(pl.Int32)
         )
-        .drop("month")
+        .agg(len=pl.len())
     )
 
-    out["users_monthly_by_joined"] = [
-        c.to_list() for c in df_users_monthly_by_joined.get_columns()
-    ]
-
-    df_activity_by_age = (
-        df_months.join(
-            df_activity.select("userid", "datestamp", "month"),
-            on="month",
-            how="left",
-            coalesce=True,
-        )
-        .join(
-            df_users.select("userid", "joindate"),
-            on="userid",
-            how="left",
-            coalesce=True,
-        )
-        .with_columns(age=(col("datestamp") - col("joindate")).dt.total_days())
-        .with_columns(
-            col("age")
-            .is_between(
-                AGE_THRESHOLDS[i] * 365.25,
-                AGE_THRESHOLDS[i + 1] * 365.25,
-                closed="left",
-            )
-            .alias(str(i))
-            for i in range(len(AGE_THRESHOLDS) - 1)
-        )
-        .group_by("month")
-        .agg(col(str(i)).sum() for i in range(len(AGE_THRESHOLDS) - 1))
-        .drop("month")
+    lf_clock = pl.concat(
+        [
+            # keys are computed first, so an alternate timezone's conversion is shared by its weekday and hour
+            df.lazy()
+            .with_columns(**clock_keys)
+            .group_by(*PARTIAL_KEYS, *clock_keys)
+            .agg(kind=lit(kind), len=pl.len())
+            for kind, df in [("posts", df_posts), ("comments", df_comments)]
+        ]
     )
 
-    out["activity_by_age"] = [c.to_list() for c in df_activity_by_age.get_columns()]
+    return {"user_months": lf_user_months, "ages": lf_ages, "clock": lf_clock}
 
-    df_users_first = (
-        df_months.join(
-            df_activity.select("userid", "month").unique("userid", keep="first"),
-            on="month",
-            how="left",
-        )
-        .group_by("month")
-        .agg(first=col("userid").len())
-    )
 
-    out["users_first"] = df_users_first.get_column("first").to_list()
+def get_post_facts_query(
+    df_posts: DataFrame, df_comments: DataFrame, compact: bool = False
+) -> LazyFrame:
+    """
+    Query for a fact table of every post, with its thread:
+    - site, postid, month: the post's
+    - comments: number of comments
+    - commenters: number of distinct commenters
+    - first_comment, last_comment: seconds from the post to its first and last comments, or null if it has none
+    - bests: number of comments marked best answer
 
-    df_users_last = (
-        df_months.join(
-            df_activity.select("userid", "month").unique("userid", keep="last"),
-            on="month",
-            how="left",
+    Comments are aggregated per (site, postid) in one hash group-by (sorting them by post first, for a merge, costs more than the whole query), then joined to the posts once, so thread stats for every site, and AskMe's best answers, are derived from it without touching the comments again.
+
+    If compact is set, the inputs use the compact schema.
+    """
+
+    def seconds(col_name: str) -> Expr:
+        # compact datestamps are seconds already
+        return col(col_name).cast(pl.Int64) if compact else col(col_name).dt.epoch("s")
+
+    lf_threads = (
+        df_comments.lazy()
+        .group_by("site", "postid")
+        .agg(
+            comments=pl.len(),
+            commenters=col("userid").n_unique(),
+            first_comment=col("datestamp").min(),
+            last_comment=col("datestamp").max(),
+            bests=(col("best") == 1).sum(),
+        )
+    )
+
+    return (
+        df_posts.lazy()
+        .select("site", "postid", "month", posted="datestamp")
+        .join(lf_threads, on=["site", "postid"], how="left", coalesce=True)
+        .select(
+            "site",
+            "postid",
+            "month",
+            col("comments", "commenters", "bests").fill_null(0),
+            first_comment=seconds("first_comment") - seconds("posted"),
+            last_comment=seconds("last_comment") - seconds("posted"),
         )
-        .group_by("month")
-        .agg(last=col("userid").len())
     )
 
-    out["users_last"] = df_users_last.get_column("last").to_list()
 
-    df_users_cum = df_users_first.select("month", cum=col("first").cum_sum())
+def get_totals_query(df_posts: DataFrame, df_comments: DataFrame) -> LazyFrame:
+    """
+    Query for post and comment counts, faves and deletions per (site, month).
+    """
 
-    out["users_cum"] = df_users_cum.get_column("cum").to_list()
+    lf_posts = (
+        df_posts.lazy()
+        .group_by(PARTIAL_KEYS)
+        .agg(
+            posts=pl.len(),
+            posts_faves=col("faves").sum(),
+            # 1: deleted, 3: deleted and closed on Metatalk
+            posts_deleted=col("deleted").is_in([1, 3]).sum(),
+        )
+    )
 
-    # get registered users for whole site
-    if site == "all":
-        df_users_registered = (
-            df_months.join(
-                df_users.select("userid", "joinmonth"),
-                left_on="month",
-                right_on="joinmonth",
-                how="left",
-                coalesce=True,
+    lf_comments = (
+        df_comments.lazy()
+        .group_by(PARTIAL_KEYS)
+        .agg(
+            comments=pl.len(),
+            comments_faves=col("faves").sum(),
+        )
+    )
+
+    return lf_posts.join(
+        lf_comments, on=PARTIAL_KEYS, how="full", coalesce=True
+    ).fill_null(0)
+
+
+def collect_queries(
+    queries: dict[str, LazyFrame],
+    lazy: bool,
+    streaming: bool = False,
+    profile: dict | None = None,
+) -> dict[str, DataFrame]:
+    """
+    Collect queries, either together with pl.collect_all, so polars can share common subplans and run them in parallel, or one at a time.
+
+    If streaming is set, collect them one at a time with the polars streaming engine, which bounds peak memory: collected together, each query's operators would hold their state at once.
+
+    If profile is given, record the queries' plans if asked, and rows out and time taken: for each query if collected one at a time, or for all of them together.
+    """
+    record_plans(profile, queries)
+
+    lap = lap_timer(profile, "partials")
+
+    if lazy and not streaming:
+        dfs = dict(zip(queries.keys(), pl.collect_all(queries.values())))
+        lap("collect_all", rows_out=sum(df.height for df in dfs.values()))
+        return dfs
+
+    dfs = {}
+    for key, lf in queries.items():
+        dfs[key] = lf.collect(engine="streaming" if streaming else "auto")
+        lap(key, rows_out=dfs[key].height)
+    return dfs
+
+
+def collect_by_site(
+    get_queries: Callable[[LazyFrame, LazyFrame, LazyFrame], dict[str, LazyFrame]],
+    df_posts_all: DataFrame | LazyFrame,
+    df_comments_all: DataFrame | LazyFrame,
+    df_activity_all: DataFrame | LazyFrame,
+    lazy: bool,
+    streaming: bool = False,
+    profile: dict | None = None,
+) -> dict[str, DataFrame]:
+    """
+    Collect partial aggregate queries one site at a time, from get_queries(posts, comments, activity) for each site's rows, and concatenate each query's results (without copying them).
+
+    The queries still group by site, but each hash table only ever holds one site's groups, rather than every site's at once, e.g. a (site, month, userid) table for all of them, which would need more memory than the loaded tables. Smaller tables are no slower to build, as they fit in cache better.
+    """
+    by_site = [
+        collect_queries(
+            get_queries(
+                *(
+                    df.lazy().filter(col("site") == site)
+                    for df in [df_posts_all, df_comments_all, df_activity_all]
+                )
+            ),
+            lazy,
+            streaming,
+            profile,
+        )
+        for site in SITES
+    ]
+
+    return {key: pl.concat([dfs[key] for dfs in by_site]) for key in by_site[0]}
+
+
+def calculate_partials(
+    df_users: DataFrame,
+    df_posts_all: DataFrame,
+    df_comments_all: DataFrame,
+    df_activity_all: DataFrame | LazyFrame,
+    *,
+    lazy: bool = False,
+    streaming: bool = False,
+    profile: dict | None = None,
+    compact: bool = False,
+    clock_tz: str | None = None,
+) -> dict[str, DataFrame]:
+    """
+    Calculate all partial aggregates, for all sites, one site at a time (see collect_by_site).
+
+    If compact is set, the inputs use the compact schema. The partials' month indexes are converted back to dates, so they're the same either way.
+    """
+
+    print("Calculate partial aggregates")
+
+    partials = collect_by_site(
+        lambda df_posts, df_comments, df_activity: {
+            **get_activity_partial_queries(
+                df_users,
+                df_posts,
+                df_comments,
+                df_activity,
+                compact,
+                clock_tz,
+            ),
+            "totals": get_totals_query(df_posts, df_comments),
+            "post_facts": get_post_facts_query(df_posts, df_comments, compact),
+        },
+        df_posts_all,
+        df_comments_all,
+        df_activity_all,
+        lazy,
+        streaming,
+        profile,
+    )
+
+    if compact:
+        partials = {
+            key: df.with_columns(from_compact_month("month"))
+            for key, df in partials.items()
+        }
+
+    return partials
+
+
+def get_concentration(
+    df_counts: DataFrame, lorenz_points: int | None = None
+) -> DataFrame:
+    """
+    Concentration of activity among users in each month, from month and count columns with a row per active user:
+    - the share of activity by the top TOP_N fraction of users, in columns named for each
+    - if lorenz_points is given, the Gini coefficient, as gini, and the Lorenz curve at that resolution, as lorenz_1 up to lorenz_{lorenz_points - 1}: for each of 1 / lorenz_points up to (lorenz_points - 1) / lorenz_points of users, from least to most active, the share of activity they have
+
+    Users are ranked once per month, by sorting their counts, and every statistic is read off the sorted counts, so the Gini coefficient and Lorenz curve cost little more than the top shares.
+    """
+
+    df = df_counts.group_by("month").agg(
+        total=col("count").sum(),
+        # least active first
+        counts=col("count").sort().cast(pl.Int64),
+    )
+    users = col("counts").list.len()
+
+    stats = [
+        (
+            col("counts").list.tail((users * n).cast(pl.Int64)).list.sum()
+            / col("total")
+        ).alias(str(n))
+        for n in TOP_N
+    ]
+
+    if lorenz_points is not None:
+        # with counts ranked i = 1..n from least active: 2 * sum(i * count) / (n * total) - (n + 1) / n
+        stats.append(
+            (
+                2
+                * col("counts")
+                .list.eval((pl.element() * pl.int_range(1, pl.len() + 1)).sum())
+                .list.first()
+                / (users * col("total"))
+                - (users + 1) / users
+            ).alias("gini")
+        )
+
+        # the share of the least active j / lorenz_points of users is the running total of their counts, up to user floor(j * n / lorenz_points)
+        df = df.with_columns(
+            lorenz=col("counts").list.eval(
+                pl.concat([pl.lit(0, pl.Int64), pl.element().cum_sum()]).gather(
+                    pl.int_range(1, lorenz_points) * pl.len() // lorenz_points
+                )
             )
-            .group_by("month")
-            .agg(col("userid").count())
-            .select(col("userid").cum_sum().alias("sum"))
         )
+        stats += [
+            (col("lorenz").list.get(j - 1) / col("total")).alias(f"lorenz_{j}")
+            for j in range(1, lorenz_points)
+        ]
 
-        out["users_registered"] = df_users_registered.get_column("sum").to_list()
+    return df.select("month", *stats)
 
-    df_posts_deleted = (
-        df_months.join(
-            df_posts.select("month", "deleted"),
-            on="month",
-            how="left",
-            coalesce=True,
+
+def to_month_number(month: Expr) -> Expr:
+    # months since year 0, so consecutive months are consecutive numbers
+    return month.dt.year() * 12 + month.dt.month()
+
+
+def get_activity_bucket(count: Expr) -> Expr:
+    log_bucket = (count.log(2) * ACTIVITY_SKETCH_OCTAVE_BUCKETS).floor().cast(
+        pl.Int32
+    ) - (
+        ACTIVITY_SKETCH_EXACT_OCTAVES * ACTIVITY_SKETCH_OCTAVE_BUCKETS
+        - ACTIVITY_SKETCH_EXACT
+    )
+    return (
+        pl.when(count < ACTIVITY_SKETCH_EXACT)
+        .then(count.cast(pl.Int32))
+        .otherwise(log_bucket)
+    )
+
+
+def from_activity_bucket(bucket: Expr) -> Expr:
+    """
+    The count a sketch bucket stands for: exact below ACTIVITY_SKETCH_EXACT, else the geometric middle of its range.
+    """
+    octaves = (
+        bucket - ACTIVITY_SKETCH_EXACT + 0.5
+    ) / ACTIVITY_SKETCH_OCTAVE_BUCKETS + ACTIVITY_SKETCH_EXACT_OCTAVES
+    return (
+        pl.when(bucket < ACTIVITY_SKETCH_EXACT)
+        .then(bucket.cast(pl.Float64))
+        .otherwise(2.0**octaves)
+    )
+
+
+def get_activity_octave(bucket: Expr) -> Expr:
+    # i for counts from 2 ** i up to 2 ** (i + 1). bucket boundaries above ACTIVITY_SKETCH_EXACT fall on every doubling
+    return (
+        pl.when(bucket < ACTIVITY_SKETCH_EXACT)
+        .then(bucket.log(2).floor())
+        .otherwise(
+            (bucket - ACTIVITY_SKETCH_EXACT) // ACTIVITY_SKETCH_OCTAVE_BUCKETS
+            + ACTIVITY_SKETCH_EXACT_OCTAVES
+        )
+        .cast(pl.Int32)
+    )
+
+
+def get_activity_sketches(df_user_months: DataFrame) -> DataFrame:
+    """
+    Sketches of how active users are in each month, from month and count columns with a row per active user per month: the users in each bucket of counts (see ACTIVITY_SKETCH_EXACT).
+
+    Sketches are small, and merge by adding up buckets, e.g. over months. Threshold counts, quantiles and histograms are all derived from them, with no further pass over the users.
+    """
+    return df_user_months.group_by(
+        "month", bucket=get_activity_bucket(col("count"))
+    ).agg(users=pl.len())
+
+
+def get_activity_quantiles(
+    df_user_months: DataFrame, df_sketches: DataFrame, quantiles: list[float]
+) -> DataFrame:
+    """
+    Quantiles of active users' counts in each month, in columns named for each: the count of the user at rank ceil(q * users), from least active.
+
+    Read off the month's sketch, by the running total of users over its buckets, so exact for counts below ACTIVITY_SKETCH_EXACT, and within about 4.4% above. Months with at most ACTIVITY_QUANTILES_EXACT_USERS users are exact, from their users' sorted counts.
+    """
+
+    def rank(users: Expr, q: float) -> Expr:
+        # rounded first, so e.g. 0.9 * 10 is rank 9, not 10
+        return (users * q).round(9).ceil().clip(lower_bound=1)
+
+    df = df_sketches.sort("month", "bucket").with_columns(
+        running=col("users").cum_sum().over("month"),
+        total=col("users").sum().over("month"),
+    )
+
+    df_quantiles = df.group_by("month").agg(
+        (col("users").sum() <= ACTIVITY_QUANTILES_EXACT_USERS).alias("small"),
+        *(
+            from_activity_bucket(
+                col("bucket").filter(col("running") >= rank(col("total"), q)).first()
+            ).alias(str(q))
+            for q in quantiles
+        ),
+    )
+
+    df_exact = (
+        df_user_months.join(
+            df_quantiles.filter("small").select("month"), on="month", how="semi"
         )
         .group_by("month")
         .agg(
-            col("deleted").filter(col("deleted").is_in([1, 3])).len()
-        )  # 1: deleted, 3: deleted and closed on Metatalk
+            col("count")
+            .sort()
+            .gather(rank(pl.len(), q).cast(pl.Int64) - 1)
+            .first()
+            .cast(pl.Float64)
+            .alias(str(q))
+            for q in quantiles
+        )
     )
 
-    out["posts_deleted"] = df_posts_deleted.get_column("deleted").to_list()
-
-    for kind, df in [("posts", df_posts), ("comments", df_comments)]:
-        df_totals = (
-            df_months.join(df, on="month", how="left", coalesce=True)
-            .group_by("month")
-            .agg(col("datestamp").count().alias("count"), pl.sum("faves"))
+    return (
+        df_quantiles.join(df_exact, on="month", how="left", suffix="_exact")
+        .select(
+            "month",
+            *(pl.coalesce(f"{q}_exact", str(q)).alias(str(q)) for q in quantiles),
         )
+        .sort("month")
+    )
 
-        out[kind] = df_totals.get_column("count").to_list()
 
-        out[f"{kind}_faves"] = df_totals.get_column("faves").to_list()
+def get_rolling_users(
+    df_user_months: DataFrame, df_months: DataFrame, windows: list[int]
+) -> DataFrame:
+    """
+    Exact distinct active users in the trailing window of months up to each of df_months' months, for each window length, in columns named for each. From month and userid columns with a row per active user per month.
 
-        for label, format in [("weekdays", "%u"), ("hours", "%H")]:
-            out[f"{kind}_{label}_percent"] = (
-                df.select("datestamp")
-                .group_by(col("datestamp").dt.to_string(format).alias(label))
-                .len()
-                .sort(by=label)
-                .select((col("len") / pl.sum("len")).round(4).alias("percent"))
-                .get_column("percent")
-                .to_list()
-            )
+    A user is counted from each month they're active in until window months later. Each user's spans are merged, by starting each at the later of its month and the end of the user's previous span, and added up as a +1 at each span's start and a -1 at its end, so each window's counts are a cumulative sum over months. One sort of the user-months serves every window.
+    """
 
-        df_activity_by_top_users = (
-            df_months.join(
-                df.select("month", "userid"), on="month", how="left", coalesce=True
+    df = (
+        df_user_months.select("userid", month=to_month_number(col("month")))
+        .sort("userid", "month")
+        .with_columns(
+            previous=pl.when(col("userid") == col("userid").shift()).then(
+                col("month").shift()
             )
-            .group_by("month")
-            .agg(
-                pl.col("userid").count().alias("len"),
-                col("userid").unique_counts().alias("counts").sort(descending=True),
+        )
+    )
+
+    df_diffs = (
+        pl.concat(
+            [
+                df.select(
+                    window=lit(window),
+                    month=pl.max_horizontal("month", col("previous") + window),
+                    diff=lit(1),
+                )
+                for window in windows
+            ]
+            + [
+                df.select(window=lit(window), month=col("month") + window, diff=lit(-1))
+                for window in windows
+            ]
+        )
+        .group_by("window", "month")
+        .agg(col("diff").sum())
+        .pivot(on="window", index="month", values="diff")
+    )
+
+    return (
+        df_months.with_columns(number=to_month_number(col("month")))
+        .join(df_diffs, left_on="number", right_on="month", how="left")
+        .sort("month")
+        .select(
+            "month",
+            *(
+                col(str(window)).fill_null(0).cum_sum().cast(UInt32)
+                for window in windows
+            ),
+        )
+    )
+
+
+def get_hll_sketches(df_user_months: DataFrame) -> DataFrame:
+    """
+    HyperLogLog sketches of the distinct users in each month, from month and userid columns: for each month and register (by the top HLL_PRECISION bits of the userid's hash) that any user hashed to, the register's value (the most leading zeros in the rest of those hashes, plus one).
+
+    Sketches merge by taking each register's max, e.g. across sites, or over a window of months.
+    """
+    rest_bits = 64 - HLL_PRECISION
+    hash = col("userid").hash(HLL_SEED)
+    return df_user_months.group_by(
+        "month", register=(hash // 2**rest_bits).cast(UInt16)
+    ).agg(
+        value=((hash % 2**rest_bits).bitwise_leading_zeros() - HLL_PRECISION + 1)
+        .cast(UInt8)
+        .max()
+    )
+
+
+def get_rolling_users_hll(
+    df_user_months: DataFrame, df_months: DataFrame, windows: list[int]
+) -> DataFrame:
+    """
+    Estimated distinct active users in the trailing window of months up to each of df_months' months, as get_rolling_users, by merging the months' HyperLogLog sketches with a rolling max of each register. The standard error is about 1.04 / sqrt(2 ** HLL_PRECISION).
+    """
+
+    registers = 2**HLL_PRECISION
+    alpha = 0.7213 / (1 + 1.079 / registers)
+
+    df_sketches = get_hll_sketches(df_user_months)
+
+    df = (
+        df_months.join(
+            DataFrame({"register": pl.int_range(registers, dtype=UInt16, eager=True)}),
+            how="cross",
+        )
+        .join(df_sketches, on=["month", "register"], how="left")
+        .sort("register", "month")
+        .select(
+            "month",
+            *(
+                col("value")
+                .fill_null(0)
+                .rolling_max(window, min_samples=1)
+                .over("register")
+                .alias(str(window))
+                for window in windows
+            ),
+        )
+    )
+
+    def estimate(window: int) -> Expr:
+        values = col(str(window))
+        raw = alpha * registers**2 / (2.0 ** -values.cast(pl.Float64)).sum()
+        empty = (values == 0).sum()
+        # linear counting, for small counts
+        return (
+            pl.when((raw <= 2.5 * registers) & (empty > 0))
+            .then(registers * (registers / empty).log())
+            .otherwise(raw)
+            .round()
+            .cast(UInt32)
+            .alias(str(window))
+        )
+
+    return (
+        df.group_by("month").agg(estimate(window) for window in windows).sort("month")
+    )
+
+
+def calculate_for_site(
+    site: str,
+    joinyears: list[int],
+    df_users: DataFrame,
+    partials: dict[str, DataFrame],
+    *,
+    profile: dict | None = None,
+    clock_by_year: bool = False,
+    cohorts: bool = False,
+    age_bins: list[float] | None = None,
+    lorenz_points: int | None = None,
+    threads: bool = False,
+    rolling_users: str | None = None,
+    activity_quantiles: bool = False,
+) -> dict:
+    """
+    Calculate stats for a given site from the partial aggregates (see collect_by_site), with the options of calculate_stats.
+
+    Returns a dictionary to be output as json, with polars Series for arrays.
+    """
+
+    print(f'Calculate stats for "{site}"')
+
+    lap = lap_timer(profile, "sites", site)
+
+    def for_site(df: DataFrame) -> DataFrame:
+        return filter_df_by_site(site, df)
+
+    # for "all", this re-aggregates every site's user months, the largest group-by after the partials. The streaming engine's holds a fraction of the eager one's memory, and is faster
+    df_user_months = (
+        for_site(partials["user_months"])
+        .lazy()
+        .group_by("month", "userid")
+        .agg(col("posts").sum(), col("comments").sum())
+        .with_columns(count=col("posts") + col("comments"))
+        .collect(engine="streaming")
+    )
+
+    # just the first and last months, rather than a sorted copy of user_months
+    df_months = get_months_df(
+        df_user_months.select(col("month").min().append(col("month").max()))
+    )
+
+    lap("user_months", rows_out=df_user_months.height)
+
+    start_date = df_months.get_column("month").first()
+    out = {
+        "_start_year": start_date.year,
+        "_start_month": start_date.month,
+    }
+
+    def by_month(df: DataFrame, fill: int | None = 0) -> DataFrame:
+        # one row per month in the site's range, filled where there was no activity, unless fill is None
+        df = df_months.join(df, on="month", how="left")
+        return (df if fill is None else df.fill_null(fill)).sort("month")
+
+    def by_bin(
+        df: DataFrame, bin: Expr, edges: int, count: Expr | None = None
+    ) -> list[pl.Series]:
+        # rows (or the sum of count) per month in each of the bins between edges, with one binary search per row and one group-by, however many bins
+        df = by_month(
+            df.group_by("month", bin=bin)
+            .agg(count=pl.len() if count is None else count.sum())
+            .filter(col("bin") >= 0)
+            .pivot(on="bin", index="month", values="count")
+        )
+        return [
+            (
+                df.get_column(str(i))
+                if str(i) in df.columns
+                else pl.repeat(0, df.height, dtype=UInt32, eager=True)
             )
-            .select(
-                (
-                    col("counts").list.head(col("counts").list.len() * n).list.sum()
-                    / col("len")
-                ).alias(str(n))
-                for n in TOP_N
+            for i in range(edges - 1)
+        ]
+
+    df_sketches = get_activity_sketches(df_user_months)
+
+    lap("activity_sketches", df_user_months.height, df_sketches.height)
+
+    # thresholds are below ACTIVITY_SKETCH_EXACT, so exact from the sketches
+    out["users_monthly"] = (
+        by_month(
+            df_sketches.group_by("month").agg(
+                col("users").filter(col("bucket") >= level).sum().alias(str(level))
+                for level in ACTIVITY_LEVELS
             )
-            .with_columns(pl.all().fill_nan(0).fill_null(0).round(3))
         )
+        .drop("month")
+        .get_columns()
+    )
+
+    lap("users_monthly", df_sketches.height, count_values(out["users_monthly"]))
 
-        out[f"{kind}_top_users"] = [
-            c.to_list() for c in df_activity_by_top_users.get_columns()
+    if activity_quantiles:
+        df_quantiles = by_month(
+            get_activity_quantiles(
+                df_user_months, df_sketches, ACTIVITY_QUANTILES
+            ).with_columns(pl.exclude("month").round(1))
+        )
+        out["users_activity_quantiles"] = [
+            df_quantiles.get_column(str(q)) for q in ACTIVITY_QUANTILES
         ]
 
-    if site == "askme":
-        df_best = (
-            df_months.join(
-                df_posts.select("month", "postid")
-                .join(
-                    df_comments.select("postid", "best"),
-                    on="postid",
-                    how="left",  # left join, so we keep posts with no comments
-                    coalesce=True,
+        octave = get_activity_octave(col("bucket"))
+        out["users_activity_histogram"] = by_bin(
+            df_sketches,
+            octave,
+            df_sketches.select(octave.max()).item() + 2,
+            col("users"),
+        )
+
+        lap(
+            "activity_quantiles",
+            df_sketches.height,
+            count_values(
+                [out["users_activity_quantiles"], out["users_activity_histogram"]]
+            ),
+        )
+
+    if rolling_users is not None:
+        get_rolling = (
+            get_rolling_users if rolling_users == "exact" else get_rolling_users_hll
+        )
+        df_rolling = get_rolling(df_user_months, df_months, ROLLING_WINDOWS)
+        out["users_rolling"] = [
+            df_rolling.get_column(str(window)) for window in ROLLING_WINDOWS
+        ]
+
+        lap(
+            "users_rolling",
+            df_user_months.height,
+            count_values(out["users_rolling"]),
+        )
+
+    # active users and their activity, by join month and month. sparse, and only on or above the diagonal, as users can't be active before they join
+    df_cohorts = (
+        df_user_months.join(
+            df_users.select("userid", "joinmonth"), on="userid", how="left"
+        )
+        .group_by("joinmonth", "month")
+        .agg(users=pl.len(), activity=col("count").sum())
+        .sort("joinmonth", "month")
+    )
+
+    lap("user_cohorts", df_user_months.height, df_cohorts.height)
+
+    df_by_joined = by_month(
+        df_cohorts.group_by("month", joinyear=col("joinmonth").dt.year())
+        .agg(col("users").sum())
+        .pivot(on="joinyear", index="month", values="users")
+    )
+
+    out["users_monthly_by_joined"] = [
+        (
+            df_by_joined.get_column(str(year))
+            if str(year) in df_by_joined.columns
+            else pl.repeat(0, df_by_joined.height, dtype=UInt32, eager=True)
+        )
+        for year in joinyears
+    ]
+
+    lap(
+        "users_monthly_by_joined",
+        df_cohorts.height,
+        count_values(out["users_monthly_by_joined"]),
+    )
+
+    if cohorts:
+        # months as offsets from the site's start month. join months may be before it
+        start_index = to_month_index(start_date)
+        out["users_cohorts"] = {
+            "joined": df_cohorts.select(
+                to_compact_month("joinmonth").cast(pl.Int32) - start_index
+            ).to_series(),
+            "month": df_cohorts.select(
+                to_compact_month("month").cast(pl.Int32) - start_index
+            ).to_series(),
+            "users": df_cohorts.get_column("users"),
+            "activity": df_cohorts.get_column("activity"),
+        }
+
+        lap("users_cohorts", rows_out=count_values(out["users_cohorts"]))
+
+    df_ages = for_site(partials["ages"])
+
+    def by_age_bin(edges: list[float]) -> list[pl.Series]:
+        return by_bin(
+            df_ages, get_age_bin(col("age_months"), edges), len(edges), col("len")
+        )
+
+    out["activity_by_age"] = by_age_bin(AGE_THRESHOLDS)
+
+    lap("activity_by_age", df_ages.height, count_values(out["activity_by_age"]))
+
+    if age_bins is not None:
+        out["activity_by_age_bins"] = by_age_bin(age_bins)
+
+        lap(
+            "activity_by_age_bins",
+            df_ages.height,
+            count_values(out["activity_by_age_bins"]),
+        )
+
+    df_users_seen = df_user_months.group_by("userid").agg(
+        first=col("month").min(), last=col("month").max()
+    )
+
+    # these series have always counted the empty left-join row in months where no users were first or last seen,
+    # so those months are 1, not 0. kept, so the published numbers don't change
+    for label in ["first", "last"]:
+        out[f"users_{label}"] = by_month(
+            df_users_seen.group_by(label).agg(pl.len()).rename({label: "month"}),
+            fill=1,
+        ).get_column("len")
+
+    out["users_cum"] = out["users_first"].cum_sum()
+
+    lap(
+        "users_first_last",
+        df_user_months.height,
+        count_values([out["users_first"], out["users_last"], out["users_cum"]]),
+    )
+
+    # get registered users for whole site
+    if site == "all":
+        out["users_registered"] = (
+            by_month(
+                df_users.group_by(month=col("joinmonth")).agg(col("userid").count())
+            )
+            .get_column("userid")
+            .cum_sum()
+        )
+
+        lap(
+            "users_registered",
+            df_users.height,
+            count_values(out["users_registered"]),
+        )
+
+    df_totals = by_month(
+        for_site(partials["totals"]).drop("site").group_by("month").agg(pl.all().sum())
+    )
+
+    out["posts_deleted"] = df_totals.get_column("posts_deleted")
+
+    df_clock = for_site(partials["clock"])
+
+    lap("totals", rows_out=count_values(out["posts_deleted"]))
+
+    for kind in ["posts", "comments"]:
+        out[kind] = df_totals.get_column(kind)
+
+        out[f"{kind}_faves"] = df_totals.get_column(f"{kind}_faves")
+
+        lap("totals", rows_out=count_values([out[kind], out[f"{kind}_faves"]]))
+
+        for suffix in ["", "_tz"] if "hour_tz" in df_clock.columns else [""]:
+            df_weekday_hours = (
+                WEEKDAY_HOURS.join(
+                    df_clock.filter(kind=kind)
+                    .group_by(weekday=f"weekday{suffix}", hour=f"hour{suffix}")
+                    .agg(col("len").sum()),
+                    on=["weekday", "hour"],
+                    how="left",
+                )
+                .fill_null(0)
+                .sort("weekday", "hour")
+            )
+
+            counts = df_weekday_hours.get_column("len")
+            out[f"{kind}_weekday_hours{suffix}"] = [
+                counts.slice(i * 24, 24) for i in range(7)
+            ]
+
+            for label, column in [("weekdays", "weekday"), ("hours", "hour")]:
+                out[f"{kind}_{label}_percent{suffix}"] = (
+                    df_weekday_hours.group_by(column)
+                    .agg(col("len").sum())
+                    .sort(column)
+                    .select((col("len") / pl.sum("len")).round(4).alias("percent"))
+                    .get_column("percent")
                 )
-                .group_by("postid")
-                .agg(
-                    month=col("month").first(),
-                    best_sum=col("best").eq(1).sum(),
-                    best_any=col("best").eq(1).any(),
+
+            lap(
+                "weekdays_hours_percent",
+                df_clock.height,
+                count_values(
+                    [
+                        out[f"{kind}_weekday_hours{suffix}"],
+                        out[f"{kind}_weekdays_percent{suffix}"],
+                        out[f"{kind}_hours_percent{suffix}"],
+                    ]
                 ),
-                on="month",
-                how="left",
             )
-            .group_by("month")
-            .agg(
-                bests=col("best_sum").sum(),
-                posts_with_best=col("best_any").sum(),
+
+        if clock_by_year:
+            years = DataFrame(
+                {
+                    "year": pl.int_range(
+                        start_date.year,
+                        df_months.get_column("month").last().year + 1,
+                        dtype=pl.Int32,
+                        eager=True,
+                    )
+                }
+            )
+
+            counts = (
+                years.join(WEEKDAY_HOURS, how="cross")
+                .join(
+                    df_clock.filter(kind=kind)
+                    .group_by(year=col("month").dt.year(), *WEEKDAY_HOURS.columns)
+                    .agg(col("len").sum()),
+                    on=["year", *WEEKDAY_HOURS.columns],
+                    how="left",
+                )
+                .fill_null(0)
+                .sort("year", *WEEKDAY_HOURS.columns)
+                .get_column("len")
+            )
+
+            out[f"{kind}_weekday_hours_by_year"] = [
+                [counts.slice((y * 7 + i) * 24, 24) for i in range(7)]
+                for y in range(years.height)
+            ]
+
+            lap(
+                "weekday_hours_by_year",
+                df_clock.height,
+                count_values(out[f"{kind}_weekday_hours_by_year"]),
+            )
+
+        df_concentration = by_month(
+            get_concentration(
+                df_user_months.filter(col(kind) > 0).select("month", count=kind),
+                lorenz_points,
+            ).with_columns(pl.exclude("month").round(3))
+        )
+
+        out[f"{kind}_top_users"] = [df_concentration.get_column(str(n)) for n in TOP_N]
+
+        lap("top_users", df_user_months.height, count_values(out[f"{kind}_top_users"]))
+
+        if lorenz_points is not None:
+            out[f"{kind}_gini"] = df_concentration.get_column("gini")
+            out[f"{kind}_lorenz"] = [
+                df_concentration.get_column(f"lorenz_{j}")
+                for j in range(1, lorenz_points)
+            ]
+
+            lap(
+                "lorenz",
+                rows_out=count_values([out[f"{kind}_gini"], out[f"{kind}_lorenz"]]),
+            )
+
+    df_post_facts = for_site(partials["post_facts"])
+
+    if threads:
+        df_threads = by_month(
+            df_post_facts.group_by("month").agg(
+                first_comment_median=(col("first_comment").median() / 3600).round(2),
+                no_comments_percent=(col("comments") == 0).mean().round(4),
+            ),
+            # months with no posts, or no comments for a median, have no value, not 0
+            fill=None,
+        )
+
+        out["posts_first_comment_median"] = df_threads.get_column(
+            "first_comment_median"
+        )
+        out["posts_no_comments_percent"] = df_threads.get_column("no_comments_percent")
+        out["posts_by_thread_size"] = by_bin(
+            df_post_facts, get_bin(col("comments"), THREAD_SIZES), len(THREAD_SIZES)
+        )
+
+        lap(
+            "threads",
+            df_post_facts.height,
+            count_values(
+                [
+                    out["posts_first_comment_median"],
+                    out["posts_no_comments_percent"],
+                    out["posts_by_thread_size"],
+                ]
+            ),
+        )
+
+    if site == "askme":
+        # best answers count towards the month of their post
+        df_bests = by_month(
+            df_post_facts.group_by("month").agg(
+                bests=col("bests").sum(), posts_with_best=(col("bests") > 0).sum()
             )
         )
 
-        out["bests"] = df_best.get_column("bests").to_list()
-        out["posts_with_best"] = df_best.get_column("posts_with_best").to_list()
+        out["bests"] = df_bests.get_column("bests")
+        out["posts_with_best"] = df_bests.get_column("posts_with_best")
+
+        lap(
+            "bests",
+            df_post_facts.height,
+            count_values([out["bests"], out["posts_with_best"]]),
+        )
 
     return out
 
 
+def calculate_sites(
+    joinyears: list[int],
+    df_users: DataFrame,
+    partials: dict[str, DataFrame],
+    *,
+    profile: dict | None = None,
+    clock_by_year: bool = False,
+    cohorts: bool = False,
+    age_bins: list[float] | None = None,
+    lorenz_points: int | None = None,
+    threads: bool = False,
+    rolling_users: str | None = None,
+    activity_quantiles: bool = False,
+) -> dict[str, dict]:
+    """
+    Calculate stats for "all" and each site from the partial aggregates.
+    """
+    return {
+        site: calculate_for_site(
+            site,
+            joinyears,
+            df_users,
+            partials,
+            profile=profile,
+            clock_by_year=clock_by_year,
+            cohorts=cohorts,
+            age_bins=age_bins,
+            lorenz_points=lorenz_points,
+            threads=threads,
+            rolling_users=rolling_users,
+            activity_quantiles=activity_quantiles,
+        )
+        for site in ["all"] + SITES
+    }
+
+
 # crunch infodump data into json
-def calculate_stats(infodump_dir: str, publication_timestamp: str) -> dict:
+def calculate_stats(
+    infodump_dir: str,
+    publication_timestamp: str,
+    *,
+    cache_dir: str | None = None,
+    lazy: bool = False,
+    streaming: bool = False,
+    memory_budget_mb: int | None = None,
+    profile: dict | None = None,
+    compact: bool = False,
+    clock_by_year: bool = False,
+    clock_tz: str | None = None,
+    cohorts: bool = False,
+    age_bins: list[float] | None = None,
+    lorenz_points: int | None = None,
+    threads: bool = False,
+    rolling_users: str | None = None,
+    activity_quantiles: bool = False,
+    file_cache_dir: str | None = None,
+    dfs: (
+        Tuple[list[int], DataFrame, DataFrame, DataFrame, DataFrame | LazyFrame] | None
+    ) = None,
+) -> dict:
     """
     Calculate stats for all sites.
 
-    Returns a dictionary to be output as json.
+    Options:
+    - lazy: collect the partial aggregates together, instead of one site at a time
+    - streaming: load and aggregate with the streaming engine, within memory_budget_mb if given
+    - profile: record wall time, rows and peak memory of each step in it (see instrument.new_profile)
+    - compact: hold posts and comments in the compact schema, which needs less memory
+    - clock_by_year: also break down weekday by hour counts by year
+    - clock_tz: also output weekday by hour stats in that timezone, e.g. "UTC"
+    - cohorts: also output active users and activity by join month and month
+    - age_bins: also output activity in those account age bins, in years on whole months, e.g. [0, 0.5, 1, 2]
+    - lorenz_points: also output Gini coefficients and Lorenz curves at that resolution
+    - threads: also output monthly thread stats
+    - rolling_users: also output distinct users over rolling windows, "exact" or "hll"
+    - activity_quantiles: also output quantiles and a histogram of users' monthly activity
+    - file_cache_dir: share parsed files between Infodumps there
+    - dfs: calculate from these, as returned by load_dfs, instead of loading the Infodump
+
+    Returns a dictionary to be output as json, with polars Series for arrays.
     """
 
+    # before anything is loaded
+    if age_bins is not None:
+        check_age_bins(age_bins)
+
     (
         joinyears,
         df_users,
         df_posts_all,
         df_comments_all,
         df_activity_all,
-    ) = load_dfs(infodump_dir)
+    ) = (
+        dfs
+        if dfs is not None
+        else load_dfs(
+            infodump_dir,
+            cache_dir=cache_dir,
+            streaming=streaming,
+            memory_budget_mb=memory_budget_mb,
+            profile=profile,
+            compact=compact,
+            file_cache_dir=file_cache_dir,
+        )
+    )
+
+    partials = calculate_partials(
+        df_users,
+        df_posts_all,
+        df_comments_all,
+        df_activity_all,
+        lazy=lazy,
+        streaming=streaming,
+        profile=profile,
+        compact=compact,
+        clock_tz=clock_tz,
+    )
+
+    # the stats only need the partials from here on, so let the tables, most of the memory in use, go before the sites' working sets join them
+    del df_posts_all, df_comments_all, df_activity_all
+
+    if streaming:
+        report_peak_rss("aggregating", memory_budget_mb)
 
     out = {
         KEY_TIMESTAMP: publication_timestamp,
         "_start_joinyear": joinyears[0],
-    }
-
-    for site in ["all"] + SITES:
-        out[site] = calculate_for_site(
-            site,
+        **({"_clock_tz": clock_tz} if clock_tz is not None else {}),
+        **({"_age_bins": age_bins} if age_bins is not None else {}),
+        **calculate_sites(
             joinyears,
             df_users,
-            df_posts_all,
-            df_comments_all,
-            df_activity_all,
-        )
+            partials,
+            profile=profile,
+            clock_by_year=clock_by_year,
+            cohorts=cohorts,
+            age_bins=age_bins,
+            lorenz_points=lorenz_points,
+            threads=threads,
+            rolling_users=rolling_users,
+            activity_quantiles=activity_quantiles,
+        ),
+    }
+
+    if streaming:
+        report_peak_rss("calculating stats", memory_budget_mb)
 
     return out
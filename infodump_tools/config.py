@@ -11,10 +11,19 @@ INFODUMP_FILENAMES = (
     + [f"commentdata_{site}" for site in SITES]
 )
 
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 5  # seconds, doubled on each retry
+DOWNLOAD_TIMEOUT = 60  # seconds, per socket operation
+
+WATCH_INTERVAL = 2  # seconds, between checks of the local files in --watch mode
+WATCH_HOMEPAGE_INTERVAL = 300  # seconds, between checks of the Infodump homepage
+
 KEY_TIMESTAMP = "_published"
 
 # need to keep js consistent with these
 ACTIVITY_LEVELS = [1, 5, 10, 25, 50]
+ACTIVITY_QUANTILES = [0.5, 0.9, 0.99]
 AGE_THRESHOLDS = [
     0,
     1,
@@ -25,3 +34,14 @@ AGE_THRESHOLDS = [
     100,  # catch-all
 ]
 TOP_N = [0.01, 0.05, 0.1]
+ROLLING_WINDOWS = [3, 12, 24]  # months
+THREAD_SIZES = [
+    0,
+    1,
+    5,
+    10,
+    25,
+    50,
+    100,
+    1000000,  # catch-all
+]
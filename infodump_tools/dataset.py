@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from datetime import date, datetime, time
+
+import polars as pl
+from infodump_tools.cache import fingerprint_sources
+from infodump_tools.calculate import get_activity, load_dfs
+from infodump_tools.config import SITES
+from polars import Enum, Expr, LazyFrame, col
+
+DATASET_META = "meta.json"
+DATASET_TABLES = ["posts", "comments"]
+DATASET_USERS = "users.parquet"
+
+# posts and comments are partitioned by these, as site=askme/year=2015/
+DATASET_PARTITIONS = {"site": Enum(SITES), "year": pl.Int32}
+
+# small enough that row group statistics on datestamp let a date range skip most of a year's file
+DATASET_ROW_GROUP_SIZE = 100_000
+
+# bump when write_dataset changes what it writes, so old datasets are rewritten
+DATASET_VERSION = 1
+
+
+def write_dataset(
+    infodump_dir: str, dataset_dir: str, cache_dir: str | None = None
+) -> None:
+    """
+    Write the parsed Infodump tables to dataset_dir, for ad-hoc queries with open_infodump:
+    - posts and comments as Parquet, hive-partitioned by site and year, sorted by datestamp within each file, with row group statistics
+    - users as a single Parquet file
+    - meta.json, with join years, column order, and a fingerprint of the source files
+
+    The dataset is written alongside and swapped into place once complete. If the source files are unchanged since the dataset was written, nothing is done.
+    """
+
+    sources = fingerprint_sources(infodump_dir)
+
+    meta_path = os.path.join(dataset_dir, DATASET_META)
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("version") == DATASET_VERSION and meta.get("sources") == sources:
+            print(f'Dataset "{dataset_dir}" is up to date')
+            return
+
+    joinyears, df_users, df_posts_all, df_comments_all, _ = load_dfs(
+        infodump_dir, cache_dir=cache_dir
+    )
+
+    parent_dir = os.path.dirname(os.path.abspath(dataset_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=parent_dir)
+
+    try:
+        columns = {}
+        for table, df in zip(DATASET_TABLES, [df_posts_all, df_comments_all]):
+            print(f"Write {table} dataset ({df.height} rows)")
+            columns[table] = df.columns
+            df.with_columns(year=col("datestamp").dt.year()).sort(
+                "site", "datestamp", maintain_order=True
+            ).write_parquet(
+                os.path.join(tmp_dir, table),
+                partition_by=list(DATASET_PARTITIONS),
+                row_group_size=DATASET_ROW_GROUP_SIZE,
+                statistics=True,
+            )
+
+        df_users.write_parquet(os.path.join(tmp_dir, DATASET_USERS), statistics=True)
+
+        with open(os.path.join(tmp_dir, DATASET_META), "w") as f:
+            json.dump(
+                {
+                    "version": DATASET_VERSION,
+                    "joinyears": joinyears,
+                    "columns": columns,
+                    "sources": sources,
+                },
+                f,
+                indent=4,
+            )
+
+        if os.path.isdir(dataset_dir):
+            shutil.rmtree(dataset_dir)
+        os.rename(tmp_dir, dataset_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    print(f'Wrote dataset to "{dataset_dir}"')
+
+
+def to_datetime(value: date | datetime) -> datetime:
+    return value if isinstance(value, datetime) else datetime.combine(value, time())
+
+
+class InfodumpDataset:
+    """
+    Lazy queries over a dataset written by write_dataset. Frames have the same columns as load_dfs's.
+
+    Filters on site and datestamp are also applied to the site and year partitions, so polars only reads the files they need, and within those, skips row groups outside the date range.
+    """
+
+    def __init__(self, dataset_dir: str):
+        self.dataset_dir = dataset_dir
+        with open(os.path.join(dataset_dir, DATASET_META)) as f:
+            self.meta = json.load(f)
+        self.joinyears: list[int] = self.meta["joinyears"]
+
+    def scan(
+        self,
+        table: str,
+        site: str | list[str] | None = None,
+        since: date | datetime | None = None,
+        until: date | datetime | None = None,
+        userids: list[int] | None = None,
+    ) -> LazyFrame:
+        """
+        Scan posts or comments, optionally for one or more sites, from since up to (not including) until, and by a list of userids.
+        """
+
+        predicates: list[Expr] = []
+
+        if site is not None:
+            predicates.append(
+                col("site").is_in([site] if isinstance(site, str) else site)
+            )
+        if since is not None:
+            since = to_datetime(since)
+            predicates += [col("year") >= since.year, col("datestamp") >= since]
+        if until is not None:
+            until = to_datetime(until)
+            predicates += [col("year") <= until.year, col("datestamp") < until]
+        if userids is not None:
+            predicates.append(col("userid").is_in(userids))
+
+        lf = pl.scan_parquet(
+            os.path.join(self.dataset_dir, table),
+            hive_partitioning=True,
+            hive_schema=DATASET_PARTITIONS,
+        )
+        if predicates:
+            lf = lf.filter(*predicates)
+
+        return lf.select(self.meta["columns"][table])
+
+    def posts(
+        self,
+        site: str | list[str] | None = None,
+        since: date | datetime | None = None,
+        until: date | datetime | None = None,
+        userids: list[int] | None = None,
+    ) -> LazyFrame:
+        return self.scan("posts", site, since, until, userids)
+
+    def comments(
+        self,
+        site: str | list[str] | None = None,
+        since: date | datetime | None = None,
+        until: date | datetime | None = None,
+        userids: list[int] | None = None,
+    ) -> LazyFrame:
+        return self.scan("comments", site, since, until, userids)
+
+    def activity(
+        self,
+        site: str | list[str] | None = None,
+        since: date | datetime | None = None,
+        until: date | datetime | None = None,
+        userids: list[int] | None = None,
+    ) -> LazyFrame:
+        """
+        Posts and comments together, as generic activity.
+        """
+        return get_activity(
+            self.posts(site, since, until, userids),
+            self.comments(site, since, until, userids),
+        )
+
+    def users(self) -> LazyFrame:
+        return pl.scan_parquet(os.path.join(self.dataset_dir, DATASET_USERS))
+
+
+def open_infodump(dataset_dir: str) -> InfodumpDataset:
+    """
+    Open a dataset written by write_dataset, e.g. open_infodump("infodump_dataset").posts(site="askme", since=date(2015, 1, 1)).collect()
+    """
+    return InfodumpDataset(dataset_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="write the Infodump as a hive-partitioned Parquet dataset, for ad-hoc queries"
+    )
+    parser.add_argument(
+        "-c",
+        "--cache-dir",
+        help="cache parsed tables as Arrow IPC in this directory",
+    )
+    parser.add_argument("infodump_dir")
+    parser.add_argument("dataset_dir")
+    args = parser.parse_args()
+
+    write_dataset(args.infodump_dir, args.dataset_dir, args.cache_dir)
@@ -1,21 +1,63 @@
 import argparse
+import hashlib
+import importlib
 import json
 import os
 import re
 import shutil
-import subprocess
+import struct
+import sys
 import tempfile
+import threading
+import time
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from typing import BinaryIO, Callable
+from urllib.error import HTTPError
 from urllib.request import Request, urlopen
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile
 
-from infodump_tools.calculate import calculate_stats
+from infodump_tools.calculate import ROLLING_USERS, calculate_stats, check_age_bins
 from infodump_tools.config import (
+    DOWNLOAD_BACKOFF,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_TIMEOUT,
+    DOWNLOAD_WORKERS,
     INFODUMP_BASE_URL,
     INFODUMP_FILENAMES,
     INFODUMP_HOMEPAGE,
     KEY_TIMESTAMP,
+    WATCH_HOMEPAGE_INTERVAL,
+    WATCH_INTERVAL,
 )
+from infodump_tools.incremental import calculate_stats_incremental
+from infodump_tools.instrument import (
+    count_values,
+    lap_timer,
+    new_profile,
+    print_profile,
+    write_profile,
+)
+from infodump_tools.manifest import read_manifest, update_manifest_file
+from infodump_tools.output import write_json
+from infodump_tools.shards import SHARD_BY, SHARD_COMPRESSIONS, write_shards
+from infodump_tools.sources import get_source_path, source_exists
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# signature, version, flags, method, time, date, crc-32, compressed size, uncompressed size, name length, extra length
+ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+
+print_lock = threading.Lock()
+
+# reloaded in this order when any of their files change, so --watch picks up edits to thresholds and metrics
+WATCH_MODULES = [
+    "infodump_tools.config",
+    "infodump_tools.timezones",
+    "infodump_tools.calculate",
+]
 
 
 def get_publication_timestamp() -> str:
@@ -26,56 +68,632 @@ def get_publication_timestamp() -> str:
         return published.strftime("%-d %B %Y %H:%M")
 
 
-def download_zip(filename: str, infodump_dir: str, user_agent: str | None) -> None:
-    url = INFODUMP_BASE_URL + filename + ".txt.zip"
+def log(message: str) -> None:
+    """
+    Print from download threads, without interleaving lines.
+    """
+    with print_lock:
+        print(message)
+
+
+def read_exact(src: BinaryIO, n: int) -> bytes:
+    data = src.read(n)
+    if len(data) != n:
+        raise BadZipFile("Unexpected end of zip stream")
+    return data
+
+
+def stream_extract(
+    src: BinaryIO,
+    member: str,
+    dst: BinaryIO,
+    progress: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Extract the first member of a zip archive from a stream, as it arrives.
+
+    Reads the member's local file header, then inflates its data into dst. So we never need the whole archive on disk, or to seek to the central directory at the end.
+
+    Calls progress, if given, with the number of compressed bytes read so far, after each chunk.
+
+    Returns the number of compressed bytes read.
+    """
+    (
+        signature,
+        _version,
+        flags,
+        method,
+        _time,
+        _date,
+        crc,
+        compressed_size,
+        _size,
+        name_length,
+        extra_length,
+    ) = ZIP_LOCAL_HEADER.unpack(read_exact(src, ZIP_LOCAL_HEADER.size))
+
+    if signature != b"PK\x03\x04":
+        raise BadZipFile("Not a zip archive")
+
+    name = read_exact(src, name_length).decode("utf-8")
+    read_exact(src, extra_length)
+
+    if name != member:
+        raise BadZipFile(f'Expected "{member}" as first member, found "{name}"')
+
+    if flags & 0x1:
+        raise BadZipFile("Encrypted zip members are not supported")
+
+    # bit 3: crc and sizes follow the data, in a data descriptor
+    has_descriptor = bool(flags & 0x8)
+
+    if method == ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif method == ZIP_STORED and not has_descriptor:
+        decompressor = None
+    else:
+        raise BadZipFile(f"Unsupported zip compression method {method}")
+
+    actual_crc = 0
+    remaining = compressed_size
+    read = 0
+
+    while decompressor is None and remaining > 0:
+        chunk = src.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise BadZipFile("Unexpected end of zip stream")
+        remaining -= len(chunk)
+        read += len(chunk)
+        actual_crc = zlib.crc32(chunk, actual_crc)
+        dst.write(chunk)
+        if progress is not None:
+            progress(read)
+
+    while decompressor is not None and not decompressor.eof:
+        chunk = src.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            raise BadZipFile("Unexpected end of zip stream")
+        read += len(chunk)
+        data = decompressor.decompress(chunk)
+        actual_crc = zlib.crc32(data, actual_crc)
+        dst.write(data)
+        if progress is not None:
+            progress(read)
+
+    if has_descriptor:
+        # optional signature, then crc. the rest of the descriptor isn't needed
+        descriptor = decompressor.unused_data + src.read(8)
+        if descriptor[:4] == b"PK\x07\x08":
+            descriptor = descriptor[4:]
+        if len(descriptor) < 4:
+            raise BadZipFile("Unexpected end of zip stream")
+        crc = int.from_bytes(descriptor[:4], "little")
+
+    if actual_crc != crc:
+        raise BadZipFile(f'Bad CRC-32 for "{member}"')
+
+    return read
+
+
+def progress_reporter(filename: str, length: int) -> Callable[[int], None] | None:
+    """
+    Print progress through a download, at every 10%. Needs the response's Content-Length.
+    """
+    if length <= 0:
+        return None
+
+    last_step = 0
+
+    def report(read: int) -> None:
+        nonlocal last_step
+        step = min(read * 10 // length, 9)
+        if step > last_step:
+            log(f'"{filename}": {step * 10}% of {length / 1e6:.1f} MB')
+            last_step = step
+
+    return report
+
+
+class ResumableReader:
+    """
+    Read a zip download: first the bytes already saved by an interrupted attempt, then the rest from the response.
+
+    Bytes from the response are appended to the partial zip file as they're read, so a later attempt can resume from there. Every byte is hashed, so we end up with the hash of the whole zip.
+    """
+
+    def __init__(self, partial_path: str, offset: int, resp: BinaryIO):
+        self.replay = open(partial_path, "rb") if offset else None
+        self.append = open(partial_path, "ab" if offset else "wb")
+        self.resp = resp
+        self.sha256 = hashlib.sha256()
+        self.length = 0
+
+    def read(self, n: int) -> bytes:
+        data = b""
+
+        if self.replay is not None:
+            data = self.replay.read(n)
+            if len(data) < n:
+                self.replay.close()
+                self.replay = None
+
+        if len(data) < n:
+            more = self.resp.read(n - len(data))
+            self.append.write(more)
+            data += more
+
+        self.sha256.update(data)
+        self.length += len(data)
+        return data
+
+    def close(self) -> None:
+        if self.replay is not None:
+            self.replay.close()
+        self.append.close()
+
+
+class CountingWriter:
+    """
+    Discard bytes written, only counting them. For checking a zip member's CRC without extracting it.
+    """
+
+    def __init__(self):
+        self.length = 0
+
+    def __enter__(self) -> "CountingWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+    def write(self, data: bytes) -> int:
+        self.length += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.length
+
+
+def download_zip(
+    filename: str,
+    infodump_dir: str,
+    user_agent: str | None,
+    manifest: dict,
+    base_url: str = INFODUMP_BASE_URL,
+    extract: bool = True,
+) -> bool:
+    """
+    Download an Infodump zip and extract its txt file into infodump_dir, decompressing as the response arrives.
+
+    Uses the validators in the manifest to:
+    - resume an interrupted download with a Range request, if its .zip.part file is still there
+    - otherwise, if the txt file is complete, make a conditional request, and skip the file if the server reports it unchanged
+
+    The txt file is written alongside as .part, and renamed into place once complete.
+
+    If extract is not set, keep the zip instead, to be read directly. It's still decompressed as it arrives, to check its CRC, but the txt file isn't written. Whichever of the two files isn't kept is removed, so they can't get out of step.
+
+    Returns whether the file changed.
+    """
+    url = base_url + filename + ".txt.zip"
 
     req = Request(url)
     if user_agent is not None:
         req.add_header("User-Agent", user_agent)
 
-    tmp_path = None
+    member = filename + ".txt"
+    path = os.path.join(infodump_dir, member)
+    part_path = path + ".part"
+    zip_path = path + ".zip"
+    zip_part_path = zip_path + ".part"
+
+    entry = manifest["files"].get(filename, {})
+    partial = entry.get("partial")
+
+    # can only resume if we know which version of the file we have part of
+    offset = 0
+    if (
+        partial is not None
+        and (partial["etag"] or partial["last_modified"])
+        and os.path.isfile(zip_part_path)
+    ):
+        offset = os.path.getsize(zip_part_path)
+
+    if offset:
+        req.add_header("Range", f"bytes={offset}-")
+        req.add_header("If-Range", partial["etag"] or partial["last_modified"])
+    elif (
+        os.path.isfile(path) and os.path.getsize(path) == entry.get("extracted_length")
+        if extract
+        else os.path.isfile(zip_path)
+        and os.path.getsize(zip_path) == entry.get("length")
+    ) and (entry.get("etag") or entry.get("last_modified")):
+        if entry.get("etag"):
+            req.add_header("If-None-Match", entry["etag"])
+        if entry.get("last_modified"):
+            req.add_header("If-Modified-Since", entry["last_modified"])
+
+    start = time.monotonic()
+
+    try:
+        resp = urlopen(req, timeout=DOWNLOAD_TIMEOUT)
+    except HTTPError as e:
+        if e.code == 304:
+            log(f'"{filename}" unchanged')
+            return False
+        if e.code == 416:
+            # partial file no longer matches the server's. start again on retry
+            os.remove(zip_part_path)
+        raise
+
+    with resp:
+        if resp.status == 206:
+            log(f'Resume "{filename}" from {offset / 1e6:.1f} MB')
+        else:
+            offset = 0
+            partial = {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+            }
+            update_manifest_file(
+                infodump_dir, manifest, filename, {**entry, "partial": partial}
+            )
+
+        length = offset + int(resp.headers.get("Content-Length", 0))
+        reader = ResumableReader(zip_part_path, offset, resp)
+
+        try:
+            with open(part_path, "wb") if extract else CountingWriter() as dst:
+                stream_extract(reader, member, dst, progress_reporter(filename, length))
+                size = dst.tell()
+
+            # read the rest of the zip (the central directory), so the hash covers all of it
+            while reader.read(DOWNLOAD_CHUNK_SIZE):
+                pass
+
+            if length > offset and reader.length != length:
+                raise BadZipFile(
+                    f'"{filename}": expected {length} bytes, got {reader.length}'
+                )
+
+            if extract:
+                os.replace(part_path, path)
+        finally:
+            reader.close()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    if extract:
+        os.remove(zip_part_path)
+        stale_path = zip_path
+    else:
+        os.replace(zip_part_path, zip_path)
+        stale_path = path
+
+    if os.path.isfile(stale_path):
+        os.remove(stale_path)
+
+    # so later runs can tell the file is still the one downloaded, and fingerprint it by the zip's hash
+    source_mtime_ns = os.stat(path if extract else zip_path).st_mtime_ns
+
+    update_manifest_file(
+        infodump_dir,
+        manifest,
+        filename,
+        {
+            "etag": partial["etag"],
+            "last_modified": partial["last_modified"],
+            "length": reader.length,
+            "sha256": reader.sha256.hexdigest(),
+            "extracted_length": size,
+            "source_mtime_ns": source_mtime_ns,
+        },
+    )
+
+    log(
+        f'{"Extracted" if extract else "Checked"} "{member}": downloaded {(reader.length - offset) / 1e6:.1f} MB, {"extracted" if extract else "checked"} {size / 1e6:.1f} MB in {time.monotonic() - start:.1f}s'
+    )
+
+    return True
+
+
+def download_zip_with_retries(
+    filename: str,
+    infodump_dir: str,
+    user_agent: str | None,
+    manifest: dict,
+    base_url: str = INFODUMP_BASE_URL,
+    retries: int = DOWNLOAD_RETRIES,
+    extract: bool = True,
+) -> bool:
+    """
+    Call download_zip, retrying failures with exponential backoff. Retries resume from where the failed attempt stopped.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return download_zip(
+                filename, infodump_dir, user_agent, manifest, base_url, extract
+            )
+        except (OSError, BadZipFile, zlib.error) as e:
+            if attempt == retries:
+                raise
+            delay = DOWNLOAD_BACKOFF * 2**attempt
+            log(f'Download "{filename}" failed ({e}), retry in {delay:.0f}s...')
+            time.sleep(delay)
+
+
+def download_zips(
+    filenames: list[str],
+    infodump_dir: str,
+    user_agent: str | None,
+    workers: int = DOWNLOAD_WORKERS,
+    base_url: str = INFODUMP_BASE_URL,
+    retries: int = DOWNLOAD_RETRIES,
+    extract: bool = True,
+) -> list[str]:
+    """
+    Download and extract several Infodump zips concurrently, with a pool of worker threads. If extract is not set, keep the zips instead.
+
+    The comment files are by far the largest, so start them first.
+
+    Records the files' validators and hashes in the download manifest, from which the stats stage fingerprints unchanged files without hashing them again (see fingerprint_file). Returns the files that changed.
+    """
+    filenames = sorted(filenames, key=lambda f: not f.startswith("commentdata_"))
+
+    manifest = read_manifest(infodump_dir)
+    changed = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                download_zip_with_retries,
+                filename,
+                infodump_dir,
+                user_agent,
+                manifest,
+                base_url,
+                retries,
+                extract,
+            ): filename
+            for filename in filenames
+        }
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            if future.result():
+                changed.append(futures[future])
+            log(f'[{done}/{len(filenames)}] Done "{futures[future]}"')
+
+    print(f"Changed files: {', '.join(sorted(changed)) or 'none'}")
+
+    return changed
+
+
+def get_output_timestamp(output_path: str) -> str | None:
+    """
+    Publication timestamp of the stats last written to output_path, if there are any.
+    """
+    if not os.path.isfile(output_path):
+        return None
+    with open(output_path, "r") as f:
+        return json.load(f).get(KEY_TIMESTAMP)
+
+
+def stat_files(paths: list[str]) -> dict[str, tuple[int, int] | None]:
+    """
+    Size and modification time of each of paths, or None if it doesn't exist. Cheap enough to check every few seconds, unlike a fingerprint.
+    """
+    stats = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stats[path] = None
+        else:
+            stats[path] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+
+def watch_infodump(
+    dev: bool,
+    infodump_dir: str,
+    output_path: str,
+    user_agent: str | None,
+    *,
+    interval: float,
+    workers: int,
+    extract: bool,
+    shard_dir: str | None,
+    shard_by: str,
+    shard_compressions: list[str] | None,
+    options: dict,
+) -> None:
+    """
+    Stay resident, and rewrite the stats whenever the Infodump or the code behind them changes, keeping the parsed tables loaded in between. options are calculate_stats' keyword arguments.
+
+    Every interval seconds, check the sizes and modification times of the Infodump files and of WATCH_MODULES' files. If files changed, reload the tables: files whose sha256 is unchanged are memory-mapped from a per-file cache in a temporary directory (see cache_file_scan) rather than parsed again. If code changed, reload its modules, and recalculate from the tables already loaded. Changes to how files are parsed need a restart.
+
+    Unless dev is set, also check the Infodump homepage every WATCH_HOMEPAGE_INTERVAL seconds, and download a new Infodump when it's published. If dev is set, only missing files are downloaded, and the publication timestamp is a stand-in from the local files (see get_local_publication_timestamp).
+
+    Errors, e.g. from a half-edited metric, are printed, and watching carries on until the next change. Stop with Ctrl-C.
+    """
+    calculate = importlib.import_module("infodump_tools.calculate")
+    code_paths = [importlib.import_module(name).__file__ for name in WATCH_MODULES]
+
+    os.makedirs(infodump_dir, exist_ok=True)
+    file_cache_dir = tempfile.mkdtemp(prefix="infodump-watch-")
+
+    publication_timestamp = None
+    download_needed = False
+    if not dev:
+        publication_timestamp = get_publication_timestamp()
+        print(f'Infodump last published "{publication_timestamp}"')
+        download_needed = get_output_timestamp(output_path) != publication_timestamp
+    homepage_checked = time.monotonic()
+
+    code = sources = dfs = None
+
+    print(f"Watch for changes every {interval:g}s, Ctrl-C to stop")
 
     try:
-        with urlopen(req) as resp, tempfile.NamedTemporaryFile(delete=False) as tmp:
-            shutil.copyfileobj(resp, tmp)
-            tmp_path = tmp.name
-
-        with ZipFile(tmp_path) as zip:
-            member = filename + ".txt"
-            with (
-                zip.open(member) as src,
-                open(os.path.join(infodump_dir, member), "wb") as dst,
+        while True:
+            if (
+                not dev
+                and time.monotonic() - homepage_checked >= WATCH_HOMEPAGE_INTERVAL
             ):
-                shutil.copyfileobj(src, dst)
+                homepage_checked = time.monotonic()
+                try:
+                    published = get_publication_timestamp()
+                except OSError as e:
+                    print(f"Couldn't check the Infodump homepage ({e})")
+                else:
+                    if published != publication_timestamp:
+                        print(f'Infodump published "{published}"')
+                        publication_timestamp = published
+                        download_needed = True
+
+            try:
+                filenames = [
+                    filename
+                    for filename in INFODUMP_FILENAMES
+                    if download_needed or not source_exists(infodump_dir, filename)
+                ]
+                if filenames:
+                    print(
+                        f"Download {'and extract ' if extract else ''}{len(filenames)} files, {workers} at a time..."
+                    )
+                    download_zips(
+                        filenames, infodump_dir, user_agent, workers, extract=extract
+                    )
+                download_needed = False
+
+                # noted before any work, so an error waits for the next change rather than repeating
+                last_code, code = code, stat_files(code_paths)
+                last_sources, sources = sources, stat_files(
+                    [
+                        get_source_path(infodump_dir, filename)
+                        for filename in INFODUMP_FILENAMES
+                    ]
+                )
+
+                if last_code is not None and code != last_code:
+                    print("Code changed, reload modules")
+                    for name in WATCH_MODULES:
+                        importlib.reload(sys.modules[name])
+                    calculate = sys.modules["infodump_tools.calculate"]
+
+                if sources != last_sources:
+                    print(f'Load changed files from "{infodump_dir}"')
+                    dfs = calculate.load_dfs(
+                        infodump_dir,
+                        cache_dir=options.get("cache_dir"),
+                        compact=options.get("compact", False),
+                        file_cache_dir=file_cache_dir,
+                    )
+                    if dev:
+                        publication_timestamp = (
+                            calculate.get_local_publication_timestamp(infodump_dir)
+                        )
+
+                if code != last_code or sources != last_sources:
+                    started = time.perf_counter()
+                    out = calculate.calculate_stats(
+                        infodump_dir, publication_timestamp, **options, dfs=dfs
+                    )
+                    print(f"Calculated in {time.perf_counter() - started:.2f}s")
+
+                    print(f'Write JSON to "{output_path}"')
+                    write_json(out, output_path)
+
+                    if shard_dir is not None:
+                        write_shards(out, shard_dir, shard_by, shard_compressions)
+            except Exception:
+                traceback.print_exc()
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stop watching")
     finally:
-        if tmp_path is not None:
-            os.remove(tmp_path)
+        shutil.rmtree(file_cache_dir, ignore_errors=True)
 
 
-def format_json(output_path: str) -> None:
-    # should keep the version consistent with package.json
-    args = ["npx", "prettier@3.8.1", "--write", output_path]
-    print(*args)
-    subprocess.run(args, check=True)
+def parse_age_bins(value: str) -> list[float]:
+    """
+    --age-bins' comma-separated edges, checked up front (see check_age_bins).
+    """
+    try:
+        edges = [float(edge) for edge in value.split(",")]
+        check_age_bins(edges)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return edges
 
 
 def download_infodump(
-    dev: bool, infodump_dir: str, output_path: str, user_agent: str | None
+    dev: bool,
+    infodump_dir: str,
+    output_path: str,
+    user_agent: str | None,
+    *,
+    cache_dir: str | None = None,
+    lazy: bool = False,
+    workers: int = DOWNLOAD_WORKERS,
+    store_dir: str | None = None,
+    verify: bool = False,
+    streaming: bool = False,
+    memory_budget_mb: int | None = None,
+    profile_path: str | None = None,
+    profile_plans: bool = False,
+    shard_dir: str | None = None,
+    shard_by: str = "site",
+    shard_compressions: list[str] | None = None,
+    extract: bool = True,
+    compact: bool = False,
+    clock_by_year: bool = False,
+    clock_tz: str | None = None,
+    cohorts: bool = False,
+    age_bins: list[float] | None = None,
+    lorenz_points: int | None = None,
+    threads: bool = False,
+    rolling_users: str | None = None,
+    activity_quantiles: bool = False,
+    watch_interval: float | None = None,
 ) -> None:
+    if watch_interval is not None:
+        watch_infodump(
+            dev,
+            infodump_dir,
+            output_path,
+            user_agent,
+            interval=watch_interval,
+            workers=workers,
+            extract=extract,
+            shard_dir=shard_dir,
+            shard_by=shard_by,
+            shard_compressions=shard_compressions,
+            options={
+                "cache_dir": cache_dir,
+                "lazy": lazy,
+                "compact": compact,
+                "clock_by_year": clock_by_year,
+                "clock_tz": clock_tz,
+                "cohorts": cohorts,
+                "age_bins": age_bins,
+                "lorenz_points": lorenz_points,
+                "threads": threads,
+                "rolling_users": rolling_users,
+                "activity_quantiles": activity_quantiles,
+            },
+        )
+        return
+
     download_needed = True
 
     publication_timestamp = get_publication_timestamp()
     print(f'Infodump last published "{publication_timestamp}"')
 
-    if os.path.isfile(output_path):
-        with open(output_path, "r") as f:
-            last_json = json.load(f)
-            if (
-                KEY_TIMESTAMP in last_json
-                and last_json[KEY_TIMESTAMP] == publication_timestamp
-            ):
-                print("Infodump already processed")
-                download_needed = False
+    if get_output_timestamp(output_path) == publication_timestamp:
+        print("Infodump already processed")
+        download_needed = False
 
     if not (download_needed or dev):
         print("Nothing to do")
@@ -83,29 +701,253 @@ def download_infodump(
 
     os.makedirs(infodump_dir, exist_ok=True)
 
-    for filename in INFODUMP_FILENAMES:
-        if download_needed or not os.path.isfile(f"{infodump_dir}/{filename}.txt"):
-            print(f'Download and extract "{filename}"...')
-            download_zip(filename, infodump_dir, user_agent)
+    filenames = [
+        filename
+        for filename in INFODUMP_FILENAMES
+        if download_needed or not source_exists(infodump_dir, filename)
+    ]
+
+    if filenames:
+        print(
+            f"Download {'and extract ' if extract else ''}{len(filenames)} files, {workers} at a time..."
+        )
+        download_zips(filenames, infodump_dir, user_agent, workers, extract=extract)
+
+    profile = new_profile(profile_plans) if profile_path is not None else None
 
     print(f'Read files from "{infodump_dir}" and calculate stats...')
-    out = calculate_stats(infodump_dir, publication_timestamp)
+    if store_dir is not None:
+        out = calculate_stats_incremental(
+            infodump_dir,
+            publication_timestamp,
+            store_dir,
+            cache_dir=cache_dir,
+            verify=verify,
+            streaming=streaming,
+            memory_budget_mb=memory_budget_mb,
+            profile=profile,
+            clock_by_year=clock_by_year,
+            clock_tz=clock_tz,
+            cohorts=cohorts,
+            age_bins=age_bins,
+            lorenz_points=lorenz_points,
+            threads=threads,
+            rolling_users=rolling_users,
+            activity_quantiles=activity_quantiles,
+            lazy=lazy,
+        )
+    else:
+        out = calculate_stats(
+            infodump_dir,
+            publication_timestamp,
+            cache_dir=cache_dir,
+            lazy=lazy,
+            streaming=streaming,
+            memory_budget_mb=memory_budget_mb,
+            profile=profile,
+            compact=compact,
+            clock_by_year=clock_by_year,
+            clock_tz=clock_tz,
+            cohorts=cohorts,
+            age_bins=age_bins,
+            lorenz_points=lorenz_points,
+            threads=threads,
+            rolling_users=rolling_users,
+            activity_quantiles=activity_quantiles,
+        )
 
+    lap = lap_timer(profile, "output")
+
+    # laid out as Prettier would, for readable diffs
     print(f'Write JSON to "{output_path}"')
-    with open(output_path, "w") as w:
-        json.dump(out, w, sort_keys=True)
+    write_json(out, output_path)
+
+    lap("json", rows_out=count_values(out))
+
+    if shard_dir is not None:
+        write_shards(out, shard_dir, shard_by, shard_compressions)
+
+        lap("shards")
 
-    print("Format JSON")
-    format_json(output_path)
+    if profile is not None:
+        print(f'Write profile to "{profile_path}"')
+        write_profile(profile, profile_path)
+        print_profile(profile)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--dev", action="store_true")
+    parser.add_argument(
+        "-c",
+        "--cache-dir",
+        help="cache parsed Infodump tables in this directory, reused while the files are unchanged",
+    )
+    parser.add_argument(
+        "-l",
+        "--lazy",
+        action="store_true",
+        help="collect all stats for all sites in one go, letting polars share work between them",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DOWNLOAD_WORKERS,
+        help="number of files to download at once",
+    )
+    parser.add_argument(
+        "-s",
+        "--store-dir",
+        help="incremental mode: keep per-month partial aggregates in this directory, and only recompute months whose data changed",
+    )
+    parser.add_argument(
+        "--verify-incremental",
+        action="store_true",
+        help="in incremental mode, also do a full recompute and diff the results",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="bounded-memory mode: stream the Infodump files with the polars streaming engine, instead of loading them whole",
+    )
+    parser.add_argument(
+        "-m",
+        "--memory-budget",
+        type=int,
+        help="in streaming mode, size streaming chunks to fit this many MB, and warn if peak memory goes over it. The loaded tables must fit in it too",
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        nargs="?",
+        const="infodump_profile.json",
+        help="record wall time, rows in and out, and peak memory for every load step and metric, write them to this json file (default %(const)s), and print a summary",
+    )
+    parser.add_argument(
+        "--profile-plans",
+        action="store_true",
+        help="with --profile, also record optimized Polars query plans",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        help="also write the stats as compact per-site json shards, with a manifest, to this directory",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=SHARD_BY,
+        default="site",
+        help="one shard per site, or per site and metric group",
+    )
+    parser.add_argument(
+        "--shard-compress",
+        nargs="+",
+        choices=SHARD_COMPRESSIONS,
+        default=[],
+        help="write precompressed siblings of each shard (.br needs the brotli package)",
+    )
+    parser.add_argument(
+        "--no-extract",
+        action="store_true",
+        help="keep the downloaded zips, and read the Infodump straight from them, instead of extracting txt files",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="hold posts and comments in a compact schema, with activity as a view over them, to use less memory. Can't be combined with --store-dir",
+    )
+    parser.add_argument(
+        "--clock-by-year",
+        action="store_true",
+        help="also output each site's posts and comments by weekday and hour for every year",
+    )
+    parser.add_argument(
+        "--clock-tz",
+        help="also output posts and comments by weekday and hour in this timezone, e.g. UTC",
+    )
+    parser.add_argument(
+        "--cohorts",
+        action="store_true",
+        help="also output each site's active users and activity by join month and month, as a sparse matrix",
+    )
+    parser.add_argument(
+        "--age-bins",
+        type=parse_age_bins,
+        help="also output each site's activity by account age in these bins, as comma-separated edges in years on whole months, e.g. 0,0.5,1,2,5,10",
+    )
+    parser.add_argument(
+        "--lorenz-points",
+        type=int,
+        help="also output each site's monthly Gini coefficients of posts and comments among users, and Lorenz curves at this resolution, e.g. 20 for every 5%% of users",
+    )
+    parser.add_argument(
+        "--threads",
+        action="store_true",
+        help="also output each site's monthly median time to first comment, share of posts with no comments, and posts by thread size",
+    )
+    parser.add_argument(
+        "--rolling-users",
+        choices=ROLLING_USERS,
+        help="also output each site's distinct active users over trailing 3, 12 and 24 months, exactly or estimated with HyperLogLog sketches",
+    )
+    parser.add_argument(
+        "--activity-quantiles",
+        action="store_true",
+        help="also output each site's monthly median, p90 and p99 of active users' posts and comments, and a histogram of users by doublings of them",
+    )
+    parser.add_argument(
+        "--watch",
+        nargs="?",
+        type=float,
+        const=WATCH_INTERVAL,
+        metavar="SECONDS",
+        help="stay resident, keep the Infodump loaded, and rewrite the stats whenever its files, a new Infodump, or the stats code change, checking every %(const)g seconds or this many. With --dev, only local files are checked",
+    )
     parser.add_argument("infodump_dir")
     parser.add_argument("output_path")
     args = parser.parse_args()
 
+    if args.store_dir is not None and args.compact:
+        parser.error("--compact can't be combined with --store-dir")
+
+    if args.streaming and args.no_extract:
+        parser.error(
+            "--streaming can't be combined with --no-extract, as zipped files are decompressed into memory whole"
+        )
+
+    if args.watch is not None and (args.store_dir or args.streaming or args.profile):
+        parser.error(
+            "--watch can't be combined with --store-dir, --streaming or --profile"
+        )
+
     user_agent = os.environ.get("INFODUMP_USER_AGENT")
 
-    download_infodump(args.dev, args.infodump_dir, args.output_path, user_agent)
+    download_infodump(
+        args.dev,
+        args.infodump_dir,
+        args.output_path,
+        user_agent,
+        cache_dir=args.cache_dir,
+        lazy=args.lazy,
+        workers=args.workers,
+        store_dir=args.store_dir,
+        verify=args.verify_incremental,
+        streaming=args.streaming,
+        memory_budget_mb=args.memory_budget,
+        profile_path=args.profile,
+        profile_plans=args.profile_plans,
+        shard_dir=args.shard_dir,
+        shard_by=args.shard_by,
+        shard_compressions=args.shard_compress,
+        extract=not args.no_extract,
+        compact=args.compact,
+        clock_by_year=args.clock_by_year,
+        clock_tz=args.clock_tz,
+        cohorts=args.cohorts,
+        age_bins=args.age_bins,
+        lorenz_points=args.lorenz_points,
+        threads=args.threads,
+        rolling_users=args.rolling_users,
+        activity_quantiles=args.activity_quantiles,
+        watch_interval=args.watch,
+    )
@@ -0,0 +1,435 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import Tuple
+
+import polars as pl
+from infodump_tools.cache import evict_file_cache, fingerprint_sources
+from infodump_tools.calculate import (
+    PARTIAL_KEYS,
+    calculate_partials,
+    calculate_sites,
+    check_age_bins,
+    collect_queries,
+    get_activity_partial_queries,
+    get_post_facts_query,
+    get_totals_query,
+    load_dfs,
+)
+from infodump_tools.config import INFODUMP_FILENAMES, KEY_TIMESTAMP, SITES
+from infodump_tools.instrument import lap_timer
+from infodump_tools.output import to_json_value
+from polars import DataFrame, LazyFrame, col, lit
+
+# bump when the partials change, so old stores are rebuilt from scratch
+STORE_VERSION = 3
+
+STORE_META = "meta.json"
+
+# parsed Infodump files, per file (see cache_file_scan), so unchanged files aren't parsed again
+STORE_FILES = "files"
+
+# partial aggregates kept in the store, all per (site, month)
+STORE_TABLES = ["user_months", "ages", "clock", "fingerprints", "users"]
+
+
+def hash_sum(*columns: str) -> pl.Expr:
+    """
+    Order-independent fingerprint of some columns: the (wrapping) sum of their row hashes.
+    """
+    return pl.struct(*columns).hash(seed=0).sum()
+
+
+def get_fingerprints(
+    df_posts_all: DataFrame,
+    df_comments_all: DataFrame,
+    store: dict[str, DataFrame] | None = None,
+    changed_files: set[str] | None = None,
+) -> DataFrame:
+    """
+    Fingerprint the columns the activity partials depend on, per (site, month) and table.
+
+    If store and changed_files are given, only the sites and tables whose files changed are fingerprinted in full. The rest can't have changed, so their fingerprints are copied from the store, up to the newest month loaded now. Their months after the store's newest are fingerprinted, as the cutoff for incomplete months (see get_cutoff_date) can move on while a file stays the same.
+    """
+    incremental = store is not None and changed_files is not None
+    if incremental:
+        stored_max = store["fingerprints"].get_column("month").max()
+        loaded_max = max(
+            df.lazy().select(col("month").max()).collect().item()
+            for df in [df_posts_all, df_comments_all]
+        )
+        incremental = stored_max is not None and loaded_max is not None
+
+    queries = []
+    for table, df, id_column, prefix in [
+        ("posts", df_posts_all, "postid", "postdata"),
+        ("comments", df_comments_all, "commentid", "commentdata"),
+    ]:
+        sites = [
+            site
+            for site in SITES
+            if not incremental or f"{prefix}_{site}" in changed_files
+        ]
+        queries.append(
+            df.lazy()
+            .filter(
+                col("site").is_in(sites) | (col("month") > stored_max)
+                if incremental
+                else col("site").is_in(sites)
+            )
+            .group_by(PARTIAL_KEYS)
+            .agg(
+                table=lit(table),
+                rows=pl.len(),
+                hash=hash_sum(id_column, "userid", "datestamp"),
+            )
+        )
+        if incremental:
+            queries.append(
+                store["fingerprints"]
+                .lazy()
+                .filter(
+                    (col("table") == table)
+                    & ~col("site").is_in(sites)
+                    & (col("month") <= loaded_max)
+                )
+            )
+
+    return pl.concat(queries).collect()
+
+
+def get_changed_months(
+    store: dict[str, DataFrame] | None,
+    fingerprints: DataFrame,
+    df_users: DataFrame,
+    df_activity_all: DataFrame | LazyFrame,
+) -> DataFrame:
+    """
+    (site, month) pairs whose activity partials need recomputing:
+    - months with added, removed or changed posts or comments, by fingerprint
+    - months with activity by a user whose joindate has changed, since activity_by_age depends on it
+
+    Every month, if there is no store.
+    """
+    if store is None:
+        return df_activity_all.lazy().select(PARTIAL_KEYS).unique().collect()
+
+    changed_by_fingerprint = (
+        store["fingerprints"]
+        .join(
+            fingerprints,
+            on=PARTIAL_KEYS + ["table"],
+            how="full",
+            coalesce=True,
+        )
+        .filter(
+            col("rows").ne_missing(col("rows_right"))
+            | col("hash").ne_missing(col("hash_right"))
+        )
+        .select(PARTIAL_KEYS)
+    )
+
+    changed_users = (
+        store["users"]
+        .join(df_users.select("userid", "joindate"), on="userid", how="full")
+        .filter(col("joindate").ne_missing(col("joindate_right")))
+        .select(userid=pl.coalesce("userid", "userid_right"))
+    )
+
+    changed_by_user = (
+        df_activity_all.lazy()
+        .join(changed_users.lazy(), on="userid", how="semi")
+        .select(PARTIAL_KEYS)
+        .collect()
+    )
+
+    return pl.concat([changed_by_fingerprint, changed_by_user]).unique()
+
+
+def read_store(
+    store_dir: str, clock_tz: str | None = None
+) -> Tuple[dict[str, DataFrame], dict[str, dict]] | Tuple[None, None]:
+    """
+    Read the aggregate store, and the fingerprints of the files it was computed from. Returns None for both if there is none, or if it was written by a different version of this code, polars or clock timezone.
+    """
+    try:
+        with open(os.path.join(store_dir, STORE_META)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None, None
+
+    sources = meta.pop("sources", None)
+    if meta != get_store_meta(clock_tz) or sources is None:
+        print("Aggregate store is out of date, rebuild it")
+        return None, None
+
+    return {
+        table: pl.read_parquet(os.path.join(store_dir, f"{table}.parquet"))
+        for table in STORE_TABLES
+    }, sources
+
+
+def get_store_meta(clock_tz: str | None = None) -> dict:
+    return {
+        "version": STORE_VERSION,
+        # row hashes are only stable within a polars version
+        "polars": pl.__version__,
+        "clock_tz": clock_tz,
+    }
+
+
+def write_store(
+    store_dir: str,
+    store: dict[str, DataFrame],
+    sources: dict[str, dict],
+    clock_tz: str | None = None,
+) -> None:
+    """
+    Write the aggregate store, with the fingerprints of the files it was computed from, to a temporary directory, then swap it into place. Parsed files are moved over from the old store.
+    """
+    parent_dir = os.path.dirname(os.path.abspath(store_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=parent_dir)
+
+    try:
+        for table in STORE_TABLES:
+            store[table].write_parquet(os.path.join(tmp_dir, f"{table}.parquet"))
+
+        with open(os.path.join(tmp_dir, STORE_META), "w") as f:
+            json.dump({**get_store_meta(clock_tz), "sources": sources}, f, indent=4)
+
+        files_dir = os.path.join(store_dir, STORE_FILES)
+        if os.path.isdir(files_dir):
+            os.rename(files_dir, os.path.join(tmp_dir, STORE_FILES))
+
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.rename(tmp_dir, store_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def diff_stats(a: dict, b: dict, path: str = "") -> list[str]:
+    """
+    Paths of the json values that differ between two stats dictionaries.
+    """
+    a, b = to_json_value(a), to_json_value(b)
+    if isinstance(a, dict) and isinstance(b, dict):
+        return [
+            diff
+            for key in sorted(a.keys() | b.keys())
+            for diff in diff_stats(a.get(key), b.get(key), f"{path}.{key}".lstrip("."))
+        ]
+    return [] if a == b else [path]
+
+
+def calculate_stats_incremental(
+    infodump_dir: str,
+    publication_timestamp: str,
+    store_dir: str,
+    *,
+    cache_dir: str | None = None,
+    verify: bool = False,
+    streaming: bool = False,
+    memory_budget_mb: int | None = None,
+    profile: dict | None = None,
+    clock_by_year: bool = False,
+    clock_tz: str | None = None,
+    cohorts: bool = False,
+    age_bins: list[float] | None = None,
+    lorenz_points: int | None = None,
+    threads: bool = False,
+    rolling_users: str | None = None,
+    activity_quantiles: bool = False,
+    lazy: bool = False,
+) -> dict:
+    """
+    Calculate stats for all sites like calculate_stats, with its options, but only recompute activity aggregates for months whose data changed, keeping them in store_dir.
+
+    If verify is set, also do a full recompute, and return it if the results differ.
+
+    Returns a dictionary to be output as json, with polars Series for arrays.
+    """
+
+    # before anything is loaded
+    if age_bins is not None:
+        check_age_bins(age_bins)
+
+    lap = lap_timer(profile, "incremental")
+
+    store, store_sources = read_store(store_dir, clock_tz)
+    sources = fingerprint_sources(infodump_dir)
+
+    changed_files = {
+        filename
+        for filename in INFODUMP_FILENAMES
+        if store_sources is None or store_sources.get(filename) != sources[filename]
+    }
+
+    lap("read_store")
+
+    print(f"Changed files: {', '.join(sorted(changed_files)) or 'none'}")
+
+    file_cache_dir = os.path.join(store_dir, STORE_FILES)
+
+    (
+        joinyears,
+        df_users,
+        df_posts_all,
+        df_comments_all,
+        df_activity_all,
+    ) = load_dfs(
+        infodump_dir,
+        cache_dir=cache_dir,
+        streaming=streaming,
+        memory_budget_mb=memory_budget_mb,
+        profile=profile,
+        file_cache_dir=file_cache_dir,
+    )
+
+    lap = lap_timer(profile, "incremental")
+
+    if os.path.isdir(file_cache_dir):
+        evict_file_cache(file_cache_dir, sources)
+
+    print("Fingerprint months")
+
+    fingerprints = get_fingerprints(df_posts_all, df_comments_all, store, changed_files)
+
+    changed = get_changed_months(store, fingerprints, df_users, df_activity_all)
+
+    lap("fingerprint", df_posts_all.height + df_comments_all.height, changed.height)
+
+    print(f"Recompute {changed.height} changed (site, month) pairs")
+
+    partials = collect_queries(
+        get_activity_partial_queries(
+            df_users,
+            *(
+                df.lazy().join(changed.lazy(), on=PARTIAL_KEYS, how="semi")
+                for df in [df_posts_all, df_comments_all, df_activity_all]
+            ),
+            clock_tz=clock_tz,
+        ),
+        lazy=lazy,
+        streaming=streaming,
+        profile=profile,
+    )
+
+    lap = lap_timer(profile, "incremental")
+
+    if store is not None:
+        partials = {
+            table: pl.concat(
+                [
+                    store[table].join(changed, on=PARTIAL_KEYS, how="anti"),
+                    df.select(store[table].columns),
+                ]
+            )
+            for table, df in partials.items()
+        }
+
+    print(f'Write aggregate store "{store_dir}"')
+
+    write_store(
+        store_dir,
+        {
+            **partials,
+            "fingerprints": fingerprints,
+            "users": df_users.select("userid", "joindate"),
+        },
+        sources,
+        clock_tz,
+    )
+
+    lap("merge_and_write_store")
+
+    # faves, deletions and best answers change retroactively all the time, and one group_by costs no more than fingerprinting them would.
+    # so recompute totals in full every run. likewise post facts, as comments on old posts change their month's thread stats
+    partials["totals"] = get_totals_query(df_posts_all, df_comments_all).collect()
+
+    lap("totals", rows_out=partials["totals"].height)
+
+    partials["post_facts"] = get_post_facts_query(
+        df_posts_all, df_comments_all
+    ).collect()
+
+    lap("post_facts", rows_out=partials["post_facts"].height)
+
+    out = {
+        KEY_TIMESTAMP: publication_timestamp,
+        "_start_joinyear": joinyears[0],
+        **({"_clock_tz": clock_tz} if clock_tz is not None else {}),
+        **({"_age_bins": age_bins} if age_bins is not None else {}),
+        **calculate_sites(
+            joinyears,
+            df_users,
+            partials,
+            profile=profile,
+            clock_by_year=clock_by_year,
+            cohorts=cohorts,
+            age_bins=age_bins,
+            lorenz_points=lorenz_points,
+            threads=threads,
+            rolling_users=rolling_users,
+            activity_quantiles=activity_quantiles,
+        ),
+    }
+
+    if verify:
+        print("Verify against full recompute")
+
+        # fingerprints copied from the store must match the data loaded now, or changed months go unnoticed, e.g. when the cutoff moves
+        keys = PARTIAL_KEYS + ["table"]
+        fingerprints_match = (
+            get_fingerprints(df_posts_all, df_comments_all)
+            .sort(keys)
+            .equals(fingerprints.sort(keys))
+        )
+        if not fingerprints_match:
+            print("Month fingerprints differ from full recompute")
+
+        partials_full = calculate_partials(
+            df_users,
+            df_posts_all,
+            df_comments_all,
+            df_activity_all,
+            lazy=lazy,
+            streaming=streaming,
+            clock_tz=clock_tz,
+        )
+
+        out_full = {
+            KEY_TIMESTAMP: publication_timestamp,
+            "_start_joinyear": joinyears[0],
+            **({"_clock_tz": clock_tz} if clock_tz is not None else {}),
+            **({"_age_bins": age_bins} if age_bins is not None else {}),
+            **calculate_sites(
+                joinyears,
+                df_users,
+                partials_full,
+                clock_by_year=clock_by_year,
+                cohorts=cohorts,
+                age_bins=age_bins,
+                lorenz_points=lorenz_points,
+                threads=threads,
+                rolling_users=rolling_users,
+                activity_quantiles=activity_quantiles,
+            ),
+        }
+
+        diffs = diff_stats(out, out_full)
+
+        if diffs:
+            print(f"Incremental stats differ from full recompute: {', '.join(diffs)}")
+
+        if diffs or not fingerprints_match:
+            # rebuilt from scratch next run
+            shutil.rmtree(store_dir, ignore_errors=True)
+            return out_full
+
+        print("Incremental stats match full recompute")
+
+    return out
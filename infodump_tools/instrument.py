@@ -0,0 +1,138 @@
+import json
+import time
+from typing import Callable
+
+import polars as pl
+from infodump_tools.memory import get_peak_rss_mb
+from polars import LazyFrame
+
+# sections of a profile, in the order they run
+PROFILE_SECTIONS = ["benchmark", "load", "partials", "incremental", "sites", "output"]
+
+
+def new_profile(plans: bool = False) -> dict:
+    """
+    An empty profile, to be filled in by lap timers as stats are calculated.
+
+    If plans is set, optimized Polars query plans are recorded too.
+    """
+    return {"plans": {}} if plans else {}
+
+
+def lap_timer(profile: dict | None, *path: str) -> Callable[..., None]:
+    """
+    A stopwatch for profiling consecutive steps. Each call lap(label, rows_in, rows_out) records, in profile[path...][label]:
+    - seconds since the previous lap (or since the timer was made)
+    - rows in and out of the step, if given
+    - peak RSS of the process so far, in MB
+
+    Steps that are lapped more than once are added up.
+
+    If profile is None, nothing is recorded, so code can be profiled without cost when nobody is asking.
+    """
+    if profile is None:
+        return lambda label, rows_in=None, rows_out=None: None
+
+    records = profile
+    for key in path:
+        records = records.setdefault(key, {})
+
+    last = time.perf_counter()
+
+    def lap(
+        label: str, rows_in: int | None = None, rows_out: int | None = None
+    ) -> None:
+        nonlocal last
+        now = time.perf_counter()
+
+        record = records.setdefault(
+            label, {"seconds": 0.0, "rows_in": None, "rows_out": None}
+        )
+        record["seconds"] += now - last
+        for key, rows in [("rows_in", rows_in), ("rows_out", rows_out)]:
+            if rows is not None:
+                record[key] = (record[key] or 0) + rows
+        record["peak_rss_mb"] = round(get_peak_rss_mb())
+
+        # don't count the time taken to take the measurements
+        last = time.perf_counter()
+
+    return lap
+
+
+def count_values(value) -> int:
+    """
+    Number of values in a json value: the total number of values in nested lists, Series and dictionaries, or 1.
+    """
+    if isinstance(value, pl.Series):
+        return value.len()
+    if isinstance(value, dict):
+        return sum(count_values(v) for v in value.values())
+    if isinstance(value, list):
+        return sum(count_values(v) for v in value)
+    return 1
+
+
+def record_plans(profile: dict | None, queries: dict[str, LazyFrame]) -> None:
+    """
+    Record the optimized query plan of each query, if the profile asks for plans.
+    """
+    if profile is None or "plans" not in profile:
+        return
+
+    for key, lf in queries.items():
+        profile["plans"][key] = lf.explain()
+
+
+def write_profile(profile: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=4)
+
+
+def format_rows(rows: int | None) -> str:
+    return "" if rows is None else str(rows)
+
+
+def print_profile(profile: dict) -> None:
+    """
+    Print a profile as readable tables: one row per load, partials and output step, and a metric by site table of seconds.
+    """
+
+    header = (
+        f"{'step':<32} {'seconds':>9} {'rows in':>12} {'rows out':>12} {'peak MB':>8}"
+    )
+
+    for section in PROFILE_SECTIONS:
+        if section == "sites" or section not in profile:
+            continue
+
+        print(f"\nProfile: {section}\n{header}")
+        for label, record in profile[section].items():
+            print(
+                f"{label:<32} {record['seconds']:>9.3f} {format_rows(record['rows_in']):>12} {format_rows(record['rows_out']):>12} {record['peak_rss_mb']:>8}"
+            )
+
+    if "sites" in profile:
+        sites = list(profile["sites"])
+        metrics = list(
+            dict.fromkeys(metric for site in sites for metric in profile["sites"][site])
+        )
+
+        print("\nProfile: sites (seconds)")
+        print(f"{'metric':<32}" + "".join(f" {site:>9}" for site in sites))
+
+        for metric in metrics + ["total"]:
+            seconds = [
+                (
+                    sum(r["seconds"] for r in profile["sites"][site].values())
+                    if metric == "total"
+                    else profile["sites"][site].get(metric, {}).get("seconds")
+                )
+                for site in sites
+            ]
+            print(
+                f"{metric:<32}"
+                + "".join("          " if s is None else f" {s:>9.3f}" for s in seconds)
+            )
+
+    print()
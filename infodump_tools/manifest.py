@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+
+from infodump_tools.sources import get_source_path
+
+MANIFEST_FILENAME = "manifest.json"
+
+# downloads run in worker threads, which all update the same manifest
+manifest_lock = threading.Lock()
+
+
+def get_manifest_path(infodump_dir: str) -> str:
+    return os.path.join(infodump_dir, MANIFEST_FILENAME)
+
+
+def read_manifest(infodump_dir: str) -> dict:
+    """
+    Read the download manifest for an Infodump directory.
+
+    "files" maps each Infodump filename to what we know about its zip:
+    - etag, last_modified: HTTP validators, for conditional and resumed requests
+    - length, sha256: byte length and hash of the complete zip
+    - extracted_length: byte length of the extracted txt file
+    - source_mtime_ns: modification time of the file kept, the txt file or the zip, when it was downloaded
+    - partial: validators of an interrupted download, which can be resumed
+    """
+    try:
+        with open(get_manifest_path(infodump_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": {}}
+
+
+def write_manifest(infodump_dir: str, manifest: dict) -> None:
+    path = get_manifest_path(infodump_dir)
+    with open(path + ".part", "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(path + ".part", path)
+
+
+def update_manifest_file(
+    infodump_dir: str, manifest: dict, filename: str, entry: dict
+) -> None:
+    """
+    Replace a file's manifest entry, and save the manifest straight away, so progress survives an interrupted run.
+    """
+    with manifest_lock:
+        manifest["files"][filename] = entry
+        write_manifest(infodump_dir, manifest)
+
+
+def read_downloaded_file(infodump_dir: str, filename: str) -> dict | None:
+    """
+    A file's manifest entry, if the file on disk is still the one that was downloaded: the same size, and the same modification time. Its zip's sha256 then identifies it, without hashing it again. None if there is no such entry.
+    """
+    entry = read_manifest(infodump_dir)["files"].get(filename)
+    if entry is None or "source_mtime_ns" not in entry:
+        return None
+
+    path = get_source_path(infodump_dir, filename)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    size = entry["length"] if path.endswith(".zip") else entry["extracted_length"]
+    if stat.st_size != size or stat.st_mtime_ns != entry["source_mtime_ns"]:
+        return None
+
+    return entry
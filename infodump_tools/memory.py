@@ -0,0 +1,50 @@
+import resource
+import sys
+
+import polars as pl
+
+# rough bytes held per row in flight while streaming an Infodump table: the raw line, the datestamp string, and the parsed columns
+STREAMING_ROW_BYTES = 256
+
+# share of the memory budget given to rows in flight. the rest is for the collected tables
+STREAMING_BUDGET_SHARE = 0.25
+
+
+def get_peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process so far, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def set_streaming_budget(memory_budget_mb: int) -> None:
+    """
+    Size the polars streaming engine's chunks to fit a memory budget.
+
+    Polars has no hard memory limit, so this is the lever we have: keep the rows in flight, across all threads, to a share of the budget. It bounds the scans, not the loaded tables or the aggregates' hash tables, so a budget below what the tables need can't be met.
+    """
+    rows = int(
+        memory_budget_mb
+        * 2**20
+        * STREAMING_BUDGET_SHARE
+        / (STREAMING_ROW_BYTES * pl.thread_pool_size())
+    )
+    rows = max(1_000, min(rows, 1_000_000))
+
+    print(f"Memory budget {memory_budget_mb} MB: stream in chunks of {rows} rows")
+
+    pl.Config.set_streaming_chunk_size(rows)
+
+
+def report_peak_rss(stage: str, memory_budget_mb: int | None = None) -> bool:
+    """
+    Log peak memory after a stage, and whether it's over memory_budget_mb, if given. Returns False if it is.
+    """
+    peak = get_peak_rss_mb()
+    print(f"Peak memory after {stage}: {peak:.0f} MB")
+    if memory_budget_mb is not None and peak > memory_budget_mb:
+        print(f"Over memory budget of {memory_budget_mb} MB")
+        return False
+    return True
@@ -0,0 +1,225 @@
+import json
+import os
+import re
+
+import polars as pl
+
+# must match .prettierrc, so the json is laid out exactly as `prettier --write` would
+PRETTIER_PRINT_WIDTH = 120
+PRETTIER_TAB_WIDTH = 4
+
+# below or above these, floats are written in exponent notation, which polars and python format differently
+PLAIN_FLOAT_RANGE = (1e-4, 1e16)
+
+
+def print_number(raw: str) -> str:
+    """
+    Normalise a json number as Prettier's printNumber does, e.g. "1e-05" to "1e-5".
+    """
+    raw = raw.lower()
+    # remove unnecessary plus and zeroes from scientific notation
+    raw = re.sub(r"^([+-]?[\d.]+e)(?:\+|(-))?0*(\d)", r"\1\2\3", raw)
+    # remove unnecessary scientific notation (1x)
+    raw = re.sub(r"^([+-]?[\d.]+)e[+-]?0+$", r"\1", raw)
+    # make sure numbers always start with a digit
+    raw = re.sub(r"^([+-])?\.", r"\g<1>0.", raw)
+    # remove extraneous trailing decimal zeroes
+    raw = re.sub(r"(\.\d+?)0+(?=e|$)", r"\1", raw)
+    # remove trailing dot
+    return re.sub(r"\.(?=e|$)", "", raw)
+
+
+def format_scalar(value) -> str:
+    text = json.dumps(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return print_number(text)
+    return text
+
+
+def format_series(s: pl.Series) -> list[str] | None:
+    """
+    Format a numeric series' values as json numbers, in one vectorised cast. Returns None if the series can't be written as a plain array of numbers.
+    """
+    if not s.dtype.is_numeric() or s.null_count() > 0:
+        return None
+
+    if s.dtype.is_float():
+        magnitudes = s.filter(s != 0).abs()
+        if (
+            not s.is_finite().all()
+            or (magnitudes < PLAIN_FLOAT_RANGE[0]).any()
+            or (magnitudes >= PLAIN_FLOAT_RANGE[1]).any()
+        ):
+            return [format_scalar(value) for value in s.to_list()]
+
+    return s.cast(pl.String).to_list()
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_matrix(value: list) -> bool:
+    """
+    Prettier always breaks an array of two or more arrays, or two or more objects, that each have more than one element.
+    """
+    if len(value) < 2:
+        return False
+    kind = dict if isinstance(value[0], dict) else (list, pl.Series)
+    return all(isinstance(v, kind) and len(v) > 1 for v in value)
+
+
+def to_node(value) -> tuple:
+    """
+    Convert a json value, in which arrays may be polars Series, to a layout node: (kind, payload, flat width, must break).
+
+    Kinds follow how Prettier prints json:
+    - "scalar": a string, number, boolean or null, as text
+    - "numbers": an array of two or more numbers, as texts. Filled onto lines when it doesn't fit on one
+    - "array": any other array, of nodes. One element per line when it doesn't fit on one
+    - "object": key and node pairs. One property per line when it doesn't fit on one
+
+    Must break is set for an array of two or more arrays (or objects) that each have two or more elements, which Prettier always breaks, and for anything containing one.
+    """
+
+    if isinstance(value, pl.Series):
+        texts = format_series(value) if value.len() > 1 else None
+        if texts is None:
+            return to_node(value.to_list())
+        # "[" + ", ".join(texts) + "]"
+        return ("numbers", texts, sum(map(len, texts)) + 2 * len(texts), False)
+
+    if isinstance(value, list):
+        if len(value) > 1 and all(is_number(v) for v in value):
+            texts = [format_scalar(v) for v in value]
+            return ("numbers", texts, sum(map(len, texts)) + 2 * len(texts), False)
+
+        nodes = [to_node(v) for v in value]
+        flat_width = sum(node[2] for node in nodes) + 2 * max(len(nodes), 1)
+        must_break = any(node[3] for node in nodes) or is_matrix(value)
+        return ("array", nodes, flat_width, must_break)
+
+    if isinstance(value, dict):
+        # keys sorted, as json.dump(sort_keys=True) did
+        properties = [
+            (json.dumps(key), to_node(value[key])) for key in sorted(value.keys())
+        ]
+        # "{ " + ", ".join(key + ": " + value) + " }", or "{}"
+        flat_width = (
+            sum(len(key) + 2 + node[2] for key, node in properties)
+            + 2 * len(properties)
+            + 2
+            if properties
+            else 2
+        )
+        must_break = any(node[3] for _, node in properties)
+        return ("object", properties, flat_width, must_break)
+
+    text = format_scalar(value)
+    return ("scalar", text, len(text), False)
+
+
+def print_flat(node: tuple) -> str:
+    kind, payload = node[0], node[1]
+    if kind == "scalar":
+        return payload
+    if kind == "numbers":
+        return f"[{', '.join(payload)}]"
+    if kind == "array":
+        return f"[{', '.join(print_flat(n) for n in payload)}]"
+    if not payload:
+        return "{}"
+    return f"{{ {', '.join(f'{key}: {print_flat(n)}' for key, n in payload)} }}"
+
+
+def print_node(node: tuple, level: int, column: int, suffix: int) -> str:
+    """
+    Print a node starting at column, at indent level, followed by suffix characters (a comma, or nothing) before the next line break.
+
+    Like Prettier, print it on one line if that fits in the print width, else break it over lines.
+    """
+    kind, payload, flat_width, must_break = node
+
+    if kind == "scalar" or (
+        not must_break and column + flat_width + suffix <= PRETTIER_PRINT_WIDTH
+    ):
+        return print_flat(node)
+
+    indent = " " * (PRETTIER_TAB_WIDTH * (level + 1))
+    closing = "\n" + " " * (PRETTIER_TAB_WIDTH * level)
+
+    if kind == "numbers":
+        # Prettier's fill: the next number goes on the same line if it fits, with its comma
+        lines = []
+        line = indent + payload[0]
+        for i, text in enumerate(payload[1:], start=1):
+            line += ","
+            last = i == len(payload) - 1
+            if len(line) + 1 + len(text) + (0 if last else 1) <= PRETTIER_PRINT_WIDTH:
+                line += " " + text
+            else:
+                lines.append(line)
+                line = indent + text
+        lines.append(line)
+        return "[\n" + "\n".join(lines) + closing + "]"
+
+    if kind == "array":
+        items = [
+            indent + print_node(n, level + 1, len(indent), int(i < len(payload) - 1))
+            for i, n in enumerate(payload)
+        ]
+        return "[\n" + ",\n".join(items) + closing + "]"
+
+    items = [
+        f"{indent}{key}: "
+        + print_node(
+            n, level + 1, len(indent) + len(key) + 2, int(i < len(payload) - 1)
+        )
+        for i, (key, n) in enumerate(payload)
+    ]
+    return "{\n" + ",\n".join(items) + closing + "}"
+
+
+def print_compact(node: tuple) -> str:
+    kind, payload = node[0], node[1]
+    if kind == "scalar":
+        return payload
+    if kind == "numbers":
+        return f"[{','.join(payload)}]"
+    if kind == "array":
+        return f"[{','.join(print_compact(n) for n in payload)}]"
+    return f"{{{','.join(f'{key}:{print_compact(n)}' for key, n in payload)}}}"
+
+
+def format_json(value, compact: bool = False) -> str:
+    """
+    Format a json value exactly as Prettier would format json.dumps(value), with .prettierrc's options. Arrays may be polars Series, which are written without converting them to python lists of numbers.
+
+    If compact is set, format it with no whitespace at all instead, for files nobody reads.
+    """
+    if compact:
+        return print_compact(to_node(value))
+    return print_node(to_node(value), 0, 0, 0) + "\n"
+
+
+def to_json_value(value):
+    """
+    Convert the polars Series in a json value to lists, e.g. to compare two values.
+    """
+    if isinstance(value, pl.Series):
+        return value.to_list()
+    if isinstance(value, dict):
+        return {key: to_json_value(v) for key, v in value.items()}
+    if isinstance(value, list):
+        return [to_json_value(v) for v in value]
+    return value
+
+
+def write_json(value, output_path: str) -> None:
+    """
+    Write stats as json, laid out as Prettier would, with no need for Node.
+    """
+    tmp_path = output_path + ".part"
+    with open(tmp_path, "w") as f:
+        f.write(format_json(value))
+    os.replace(tmp_path, output_path)
@@ -0,0 +1,219 @@
+import gzip
+import hashlib
+import os
+import re
+
+import polars as pl
+from infodump_tools.config import KEY_TIMESTAMP
+from infodump_tools.output import format_json, write_json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SHARDS_MANIFEST = "manifest.json"
+
+# shard by site, or by site and metric group
+SHARD_BY = ["site", "group"]
+
+# metric groups, for sharding by group. metrics in no group go in "other"
+SHARD_GROUPS = {
+    "users": [
+        "users_monthly",
+        "users_monthly_by_joined",
+        "users_rolling",
+        "users_activity_quantiles",
+        "users_activity_histogram",
+        "users_cohorts",
+        "users_first",
+        "users_last",
+        "users_cum",
+        "users_registered",
+    ],
+    "activity": [
+        "posts",
+        "comments",
+        "posts_faves",
+        "comments_faves",
+        "posts_deleted",
+        "bests",
+        "posts_with_best",
+        "activity_by_age",
+        "activity_by_age_bins",
+        "posts_first_comment_median",
+        "posts_no_comments_percent",
+        "posts_by_thread_size",
+    ],
+    "clock": [
+        "posts_weekdays_percent",
+        "posts_hours_percent",
+        "comments_weekdays_percent",
+        "comments_hours_percent",
+        "posts_weekday_hours",
+        "comments_weekday_hours",
+        "posts_weekday_hours_by_year",
+        "comments_weekday_hours_by_year",
+        "posts_weekdays_percent_tz",
+        "posts_hours_percent_tz",
+        "comments_weekdays_percent_tz",
+        "comments_hours_percent_tz",
+        "posts_weekday_hours_tz",
+        "comments_weekday_hours_tz",
+    ],
+    "top_users": [
+        "posts_top_users",
+        "comments_top_users",
+        "posts_gini",
+        "comments_gini",
+        "posts_lorenz",
+        "comments_lorenz",
+    ],
+}
+
+# cumulative series are stored as differences between consecutive months, which are much smaller numbers.
+# decode with a running total
+SHARD_ENCODINGS = {"users_cum": "delta", "users_registered": "delta"}
+
+SHARD_COMPRESSIONS = ["gz", "br"]
+
+# content-hashed shard files, and their precompressed siblings
+SHARD_FILENAME = re.compile(r"^[\w.]+\.[0-9a-f]{12}\.json(\.gz|\.br)?$")
+
+
+def delta_encode(s: pl.Series) -> pl.Series:
+    """
+    First value, then differences between consecutive values.
+    """
+    return s.diff().fill_null(s.first())
+
+
+def get_shard_groups(site_out: dict) -> dict[str, list[str]]:
+    """
+    Group a site's metrics for sharding by group.
+    """
+    metrics = [key for key in sorted(site_out) if not key.startswith("_")]
+    grouped = {
+        group: [metric for metric in members if metric in site_out]
+        for group, members in SHARD_GROUPS.items()
+    }
+    grouped["other"] = [
+        metric
+        for metric in metrics
+        if not any(metric in members for members in SHARD_GROUPS.values())
+    ]
+    return {group: members for group, members in grouped.items() if members}
+
+
+def get_shards(out: dict, shard_by: str) -> dict[str, dict]:
+    """
+    Split stats into shards: one per site, or one per site and metric group. Each shard includes its site's start year and month.
+    """
+    shards = {}
+    for site, site_out in out.items():
+        if site.startswith("_"):
+            continue
+
+        start = {key: value for key, value in site_out.items() if key.startswith("_")}
+
+        if shard_by == "site":
+            groups = {None: [key for key in site_out if not key.startswith("_")]}
+        else:
+            groups = get_shard_groups(site_out)
+
+        for group, metrics in groups.items():
+            shards[site if group is None else f"{site}.{group}"] = {
+                **start,
+                **{
+                    metric: (
+                        delta_encode(site_out[metric])
+                        if SHARD_ENCODINGS.get(metric) == "delta"
+                        else site_out[metric]
+                    )
+                    for metric in metrics
+                },
+            }
+
+    return shards
+
+
+def compress(data: bytes, compression: str) -> bytes | None:
+    """
+    Compress a shard. Deterministic, so unchanged shards get identical files. Returns None for brotli if it isn't installed.
+    """
+    if compression == "gz":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is None:
+        return None
+    return brotli.compress(data, quality=11)
+
+
+def write_shards(
+    out: dict,
+    shard_dir: str,
+    shard_by: str = "site",
+    compressions: list[str] | None = None,
+) -> None:
+    """
+    Write stats as compact json shards, for the frontend to load one site (or metric group) at a time, plus a manifest listing them.
+
+    Shard files are named by a hash of their contents, so unchanged shards keep their names, and can stay cached across deploys. Each can have precompressed .gz and .br siblings. Shards from earlier runs that are no longer listed are removed.
+
+    The manifest has the publication timestamp, start join year, sites, encodings of any series that aren't stored as-is, and each shard's file, sha256, size and compressed sizes.
+    """
+
+    compressions = compressions or []
+
+    if "br" in compressions and brotli is None:
+        print("brotli is not installed, so .br shards are skipped")
+
+    os.makedirs(shard_dir, exist_ok=True)
+
+    shards = {}
+    for name, shard in get_shards(out, shard_by).items():
+        data = format_json(shard, compact=True).encode("utf-8")
+        sha256 = hashlib.sha256(data).hexdigest()
+        filename = f"{name}.{sha256[:12]}.json"
+
+        entry = {"file": filename, "sha256": sha256, "bytes": len(data)}
+
+        # unchanged shards are already there
+        path = os.path.join(shard_dir, filename)
+        if not os.path.isfile(path):
+            with open(path + ".part", "wb") as f:
+                f.write(data)
+            os.replace(path + ".part", path)
+
+        for compression in compressions:
+            compressed = compress(data, compression)
+            if compressed is None:
+                continue
+            with open(f"{path}.{compression}", "wb") as f:
+                f.write(compressed)
+            entry[f"{compression}_bytes"] = len(compressed)
+
+        shards[name] = entry
+
+    print(f'Write {len(shards)} shards and manifest to "{shard_dir}"')
+
+    write_json(
+        {
+            KEY_TIMESTAMP: out[KEY_TIMESTAMP],
+            "_start_joinyear": out["_start_joinyear"],
+            "sites": [site for site in out if not site.startswith("_")],
+            "shard_by": shard_by,
+            "encodings": SHARD_ENCODINGS,
+            "shards": shards,
+        },
+        os.path.join(shard_dir, SHARDS_MANIFEST),
+    )
+
+    current = {
+        f"{entry['file']}{suffix}"
+        for entry in shards.values()
+        for suffix in ["", *(f".{compression}" for compression in compressions)]
+    }
+    for filename in os.listdir(shard_dir):
+        if SHARD_FILENAME.match(filename) and filename not in current:
+            print(f'Remove old shard "{filename}"')
+            os.remove(os.path.join(shard_dir, filename))
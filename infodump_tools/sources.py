@@ -0,0 +1,57 @@
+import os
+from typing import BinaryIO
+from zipfile import ZipFile
+
+
+def get_txt_path(infodump_dir: str, filename: str) -> str:
+    return os.path.join(infodump_dir, f"{filename}.txt")
+
+
+def get_zip_path(infodump_dir: str, filename: str) -> str:
+    return os.path.join(infodump_dir, f"{filename}.txt.zip")
+
+
+def get_source_path(infodump_dir: str, filename: str) -> str:
+    """
+    Path of an Infodump file's source: the extracted txt file if there is one, else the downloaded zip.
+    """
+    txt_path = get_txt_path(infodump_dir, filename)
+    zip_path = get_zip_path(infodump_dir, filename)
+    if not os.path.isfile(txt_path) and os.path.isfile(zip_path):
+        return zip_path
+    return txt_path
+
+
+def source_exists(infodump_dir: str, filename: str) -> bool:
+    return os.path.isfile(get_source_path(infodump_dir, filename))
+
+
+def open_source(infodump_dir: str, filename: str) -> BinaryIO:
+    """
+    Open an Infodump file for reading, as bytes, whether it's extracted or still zipped. Zipped files are decompressed as they're read, so reading the first line only decompresses the start of the file.
+    """
+    path = get_source_path(infodump_dir, filename)
+    if not path.endswith(".zip"):
+        return open(path, "rb")
+
+    archive = ZipFile(path)
+    try:
+        f = archive.open(f"{filename}.txt")
+    except Exception:
+        archive.close()
+        raise
+    # the member keeps its own handle on the file, so the archive can be closed now
+    archive.close()
+    return f
+
+
+def read_source(infodump_dir: str, filename: str) -> str | bytes:
+    """
+    An Infodump file as a polars CSV source: the path of the extracted txt file, or, if there's only the zip, its txt member decompressed into memory in one go.
+    """
+    path = get_source_path(infodump_dir, filename)
+    if not path.endswith(".zip"):
+        return path
+
+    with ZipFile(path) as archive:
+        return archive.read(f"{filename}.txt")
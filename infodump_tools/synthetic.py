@@ -0,0 +1,302 @@
+import argparse
+import os
+from collections.abc import Iterable, Iterator
+from datetime import datetime, timedelta, timezone
+
+import polars as pl
+from infodump_tools.calculate import convert_tz
+from infodump_tools.config import INFODUMP_FILE_TIMESTAMP_TZ, INFODUMP_TZ, SITES
+from polars import DataFrame, Expr, col, lit
+
+# share of comments on each site
+SYNTHETIC_SITE_SHARES = {
+    "mefi": 0.4,
+    "askme": 0.3,
+    "meta": 0.1,
+    "fanfare": 0.1,
+    "music": 0.1,
+}
+
+SYNTHETIC_SITE_STARTS = {
+    "mefi": datetime(1999, 7, 14),
+    "askme": datetime(2003, 12, 8),
+    "meta": datetime(2000, 1, 1),
+    "fanfare": datetime(2014, 3, 1),
+    "music": datetime(2008, 2, 1),
+}
+
+SYNTHETIC_COMMENTS_PER_POST = 20
+SYNTHETIC_COMMENTS_PER_USER = 50
+
+# user n of N joins (n / N) ** SYNTHETIC_JOIN_CURVE of the way through the Infodump's history
+SYNTHETIC_JOIN_CURVE = 0.8
+
+# higher is more heavy-tailed: a few early users make most posts and comments
+SYNTHETIC_ACTIVITY_SKEW = 3
+
+# comments are generated and written this many rows at a time, to bound memory
+SYNTHETIC_CHUNK_ROWS = 5_000_000
+
+
+def uniform(seed: int, offset: int, rows: int) -> Expr:
+    """
+    Pseudo-random floats in [0, 1), one per row, from hashing the row index. The same seed and rows give the same numbers.
+    """
+    return (
+        pl.int_range(offset, offset + rows, dtype=pl.UInt64).hash(seed) // 2**11
+    ) / float(2**53)
+
+
+def to_datestamp(seconds: Expr, milliseconds: Expr) -> Expr:
+    """
+    Format seconds since the Unix epoch (naive, Mefi server time) as an Infodump datestamp, e.g. "Jul  4 1999  1:05:03:000PM".
+    """
+    dt = (seconds * 1000).cast(pl.Datetime("ms"))
+    return pl.concat_str(
+        dt.dt.to_string("%b %e %Y %l:%M:%S:"),
+        milliseconds.cast(pl.String).str.zfill(3),
+        dt.dt.to_string("%p"),
+    )
+
+
+def to_seconds(dt: datetime) -> int:
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+
+def active_userid(seconds: Expr, u: Expr, start: int, end: int, users: int) -> Expr:
+    """
+    A heavy-tailed choice of userid among the users who had joined by `seconds`, so activity follows joindate.
+    """
+    joined = (
+        users * ((seconds - start) / (end - start)) ** (1 / SYNTHETIC_JOIN_CURVE)
+    ).clip(1, users)
+    return (
+        (1 + joined * u**SYNTHETIC_ACTIVITY_SKEW).floor().clip(1, users).cast(pl.UInt32)
+    )
+
+
+def write_infodump_file(
+    path: str, published: datetime, dfs: Iterable[DataFrame]
+) -> None:
+    """
+    Write an Infodump txt file: a timestamp line, then the tab-separated table, one chunk at a time.
+    """
+    with open(path, "wb") as f:
+        f.write(f"{published.strftime('%a %b %d %H:%M:%S %Y')}\n".encode("utf-8"))
+        for i, df in enumerate(dfs):
+            df.write_csv(f, separator="\t", include_header=i == 0)
+
+
+def generate_site(
+    infodump_dir: str,
+    site: str,
+    comments: int,
+    users: int,
+    start: int,
+    end: int,
+    published: datetime,
+    seed: int,
+) -> None:
+    """
+    Write postdata and commentdata files for a site.
+    """
+
+    site_start = max(start, to_seconds(SYNTHETIC_SITE_STARTS[site]))
+    site_seed = seed * 1000 + SITES.index(site) * 100
+    posts = max(1, comments // SYNTHETIC_COMMENTS_PER_POST)
+
+    def u(stream: int, offset: int = 0, rows: int = posts) -> Expr:
+        return uniform(site_seed + stream, offset, rows)
+
+    # postids increase with datestamp, as on the real site
+    df_posts = (
+        pl.select(
+            seconds=(site_start + u(0) * (end - site_start)).cast(pl.Int64).sort(),
+            milliseconds=(u(1) * 1000).cast(pl.UInt16),
+            u_user=u(2),
+            u_faves=u(3),
+            u_deleted=u(4),
+            u_category=u(5),
+        )
+        .with_row_index("postid", offset=1)
+        .with_columns(
+            userid=active_userid(col("seconds"), col("u_user"), start, end, users)
+        )
+    )
+
+    print(f"Generate {comments} comments for {site}")
+
+    comment_counts = []
+
+    def generate_comments() -> Iterator[DataFrame]:
+        for offset in range(0, comments, SYNTHETIC_CHUNK_ROWS):
+            rows = min(SYNTHETIC_CHUNK_ROWS, comments - offset)
+
+            df_chunk = (
+                pl.select(
+                    # popular posts get more comments
+                    postid=(1 + u(10, offset, rows) ** 1.5 * posts)
+                    .floor()
+                    .clip(1, posts)
+                    .cast(pl.UInt32),
+                    u_delay=u(11, offset, rows),
+                    u_user=u(12, offset, rows),
+                    u_faves=u(13, offset, rows),
+                    u_best=u(14, offset, rows),
+                    milliseconds=(u(15, offset, rows) * 1000).cast(pl.UInt16),
+                )
+                .with_row_index("commentid", offset=offset + 1)
+                .join(df_posts.select("postid", "seconds"), on="postid", how="left")
+                .with_columns(
+                    # most comments come within hours of the post, a few trickle in over a month
+                    seconds=(col("seconds") + col("u_delay") ** 8 * 30 * 86400)
+                    .clip(upper_bound=end)
+                    .cast(pl.Int64)
+                )
+                .with_columns(
+                    userid=active_userid(
+                        col("seconds"), col("u_user"), start, end, users
+                    )
+                )
+            )
+
+            comment_counts.append(df_chunk.group_by("postid").agg(pl.len()))
+
+            yield df_chunk.select(
+                "commentid",
+                "postid",
+                "userid",
+                datestamp=to_datestamp(col("seconds"), col("milliseconds")),
+                faves=(col("u_faves") ** 4 * 40).cast(pl.UInt16),
+                **{
+                    "best answer?": (
+                        (col("u_best") < 0.03) if site == "askme" else lit(False)
+                    ).cast(pl.UInt8)
+                },
+            )
+
+    write_infodump_file(
+        os.path.join(infodump_dir, f"commentdata_{site}.txt"),
+        published,
+        generate_comments(),
+    )
+
+    df_comment_counts = (
+        pl.concat(comment_counts).group_by("postid").agg(col("len").sum())
+    )
+
+    # 1: deleted, 3: deleted and closed on Metatalk
+    deleted = (
+        pl.when(col("u_deleted") >= 0.05)
+        .then(0)
+        .when((site == "meta") & (col("u_deleted") < 0.01))
+        .then(3)
+        .otherwise(1)
+    )
+
+    write_infodump_file(
+        os.path.join(infodump_dir, f"postdata_{site}.txt"),
+        published,
+        [
+            df_posts.join(df_comment_counts, on="postid", how="left").select(
+                "postid",
+                "userid",
+                datestamp=to_datestamp(col("seconds"), col("milliseconds")),
+                # early AskMes were stored in the MeTa table, with category 10
+                category=pl.when((site == "meta") & (col("u_category") < 0.02))
+                .then(10)
+                .otherwise((col("u_category") * 9).cast(pl.UInt8) + 1),
+                comments=col("len").fill_null(0),
+                favorites=(col("u_faves") ** 3 * 100).cast(pl.UInt16),
+                deleted=deleted,
+                reason=pl.when(deleted > 0)
+                .then(lit("deleted"))
+                .otherwise(lit("[NULL]")),
+            ),
+        ],
+    )
+
+
+def generate_infodump(
+    infodump_dir: str,
+    comments: int,
+    seed: int = 0,
+    published: datetime | None = None,
+) -> None:
+    """
+    Write a synthetic Infodump to infodump_dir: usernames.txt, postdata_<site>.txt and commentdata_<site>.txt, with the real files' headers and first-line timestamp.
+
+    Scales from 10k to 100M comments, with one post per SYNTHETIC_COMMENTS_PER_POST comments and one user per SYNTHETIC_COMMENTS_PER_USER. Per-user activity is heavy-tailed. Deleted posts have a reason, others "[NULL]", and a few MeTa posts are early AskMes in category 10. A few active users are missing from usernames.txt, as in the real Infodump.
+
+    Output is deterministic for a given comments, seed and published timestamp (UTC, defaults to now).
+    """
+
+    if published is None:
+        published = datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+
+    os.makedirs(infodump_dir, exist_ok=True)
+
+    # datestamps are naive Mefi server time, up to an hour before publication
+    start = to_seconds(SYNTHETIC_SITE_STARTS["mefi"])
+    end = to_seconds(
+        convert_tz(published, INFODUMP_FILE_TIMESTAMP_TZ, INFODUMP_TZ)
+        - timedelta(hours=1)
+    )
+
+    users = max(10, comments // SYNTHETIC_COMMENTS_PER_USER)
+
+    for site in SITES:
+        generate_site(
+            infodump_dir,
+            site,
+            max(1, int(comments * SYNTHETIC_SITE_SHARES[site])),
+            users,
+            start,
+            end,
+            published,
+            seed,
+        )
+
+    print(f"Generate {users} users")
+
+    write_infodump_file(
+        os.path.join(infodump_dir, "usernames.txt"),
+        published,
+        [
+            pl.select(
+                userid=pl.int_range(1, users + 1, dtype=pl.UInt32),
+                u_join=uniform(seed * 1000 + 900, 0, users),
+                u_missing=uniform(seed * 1000 + 901, 0, users),
+            )
+            .filter(col("u_missing") >= 0.0005)
+            .select(
+                "userid",
+                joindate=to_datestamp(
+                    (
+                        start
+                        + ((col("userid") - 1 + col("u_join")) / users)
+                        ** SYNTHETIC_JOIN_CURVE
+                        * (end - start)
+                    ).cast(pl.Int64),
+                    lit(0),
+                ),
+                name=pl.format("user{}", "userid"),
+            ),
+        ],
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--comments",
+        type=int,
+        default=1_000_000,
+        help="number of comments, across all sites",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("infodump_dir")
+    args = parser.parse_args()
+
+    generate_infodump(args.infodump_dir, args.comments, args.seed)
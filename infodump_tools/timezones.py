@@ -0,0 +1,101 @@
+from datetime import datetime
+from functools import cache
+
+import polars as pl
+from polars import DataFrame, Expr, col
+
+# transitions are found at this resolution, so zones whose offsets change other than on the hour aren't supported
+TRANSITION_STEP = "1h"
+
+TRANSITION_RANGE = (datetime(1990, 1, 1), datetime(2100, 1, 1))
+
+
+@cache
+def get_transitions(tz: str) -> DataFrame:
+    """
+    The UTC offset transitions of a timezone, as a table to look up UTC or naive local times in:
+    - utc: seconds since the Unix epoch, from which offset applies
+    - local: the same in naive local time
+    - offset: UTC offset in seconds, local time minus UTC
+
+    The first row applies from the start of time. Both utc and local are sorted.
+
+    Nonexistent and ambiguous local times resolve as Python's zoneinfo does with fold=0: both take the offset from before the transition. So a nonexistent time is shifted forward by the gap (2:30 PST is 3:30 PDT), and an ambiguous time is the earlier of its two instants (1:30 PDT, not 1:30 PST). That is, the new offset applies from the later of the transition's two local times.
+
+    Built once per timezone.
+    """
+    utc = pl.datetime_range(
+        *TRANSITION_RANGE, interval=TRANSITION_STEP, time_unit="ms", eager=True
+    )
+    df = DataFrame(
+        {
+            "utc": utc.dt.epoch("s"),
+            "offset": (
+                utc.dt.replace_time_zone("UTC")
+                .dt.convert_time_zone(tz)
+                .dt.replace_time_zone(None)
+                - utc
+            ).dt.total_seconds(),
+        }
+    )
+
+    transitions = (
+        df.with_columns(previous=col("offset").shift(1))
+        .filter(col("offset") != col("previous"))
+        .select(
+            "utc",
+            local=col("utc") + pl.max_horizontal("offset", "previous"),
+            offset="offset",
+        )
+    )
+
+    return pl.concat(
+        [
+            df.head(1).select(
+                utc=pl.lit(-(2**62), pl.Int64),
+                local=pl.lit(-(2**62), pl.Int64),
+                offset="offset",
+            ),
+            transitions,
+        ]
+    )
+
+
+def lookup_offset(seconds: Expr, tz: str, key: str) -> Expr:
+    """
+    The UTC offset applying at each of seconds, by a binary search of the transition table's key column ("utc" or "local").
+    """
+    transitions = get_transitions(tz)
+    if transitions.height == 1:
+        # a fixed offset, e.g. UTC
+        return pl.lit(transitions.get_column("offset").item())
+
+    i = pl.lit(transitions.get_column(key)).search_sorted(seconds, side="right") - 1
+    return pl.lit(transitions.get_column("offset")).gather(i)
+
+
+def local_to_utc(local_seconds: Expr, tz: str) -> Expr:
+    """
+    Convert naive local times in tz, as seconds since the Unix epoch, to UTC seconds since the Unix epoch.
+
+    Each time's offset is found by a binary search of the transition table (see get_transitions for the rules for nonexistent and ambiguous times), so there's no per-row timezone arithmetic, and no errors at DST transitions.
+    """
+    return local_seconds - lookup_offset(local_seconds, tz, "local")
+
+
+def utc_to_local(utc_seconds: Expr, tz: str) -> Expr:
+    """
+    Convert UTC seconds since the Unix epoch to naive local times in tz, as seconds since the Unix epoch.
+    """
+    return utc_seconds + lookup_offset(utc_seconds, tz, "utc")
+
+
+def weekday(seconds: Expr) -> Expr:
+    """
+    ISO weekday (Monday is 1) of seconds since the Unix epoch, which was a Thursday.
+    """
+    return ((seconds // 86400 + 3) % 7 + 1).cast(pl.UInt8)
+
+
+def hour(seconds: Expr) -> Expr:
+    return (seconds % 86400 // 3600).cast(pl.UInt8)